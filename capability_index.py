@@ -0,0 +1,156 @@
+# This file builds and queries a detection-capability index over a processed catalog, answering
+#   questions like "around which stars could Gaia detect a 1 M_J companion at 2 AU?" without
+#   opening any plots.
+#
+# The SNR1 = 1 line of every star is M_p * a = K (see utilities.snr1_threshold_constant), so the
+#   threshold mass as a function of semi-major axis is K / a. The index stores K for both deviation
+#   angle models together with the semi-major axis range covered by the star's period grid, and
+#   keeps the stars sorted by K per model. A query is then a binary search plus a filter on the
+#   candidates, and the candidates come out ranked by sensitivity (smallest K first).
+#
+# Build:  python capability_index.py build gaia_query_results.pkl -o capability_index.npz
+#         (or pass a --run_dir directory; --nobs_table and --dr5 select the N_obs-aware SNR)
+# Query:  python capability_index.py query capability_index.npz --mass 1 --a 2 [--model actual] [--top 20]
+#         python capability_index.py query capability_index.npz --mass 1 --a_min 1 --a_max 3
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import checkpoint
+import obs_counts
+import utilities
+
+MODELS = ("theoretical", "actual")
+INDEX_FILENAME = "capability_index.npz"
+
+def build_index(query_result_df, n_obs=None):
+    """
+    Returns the index arrays for the stars of a (cleaned) query result
+    n_obs: expected number of observations per star for the N_obs-aware SNR, or None
+    """
+
+    stellar_mass = query_result_df["mass_flame"].to_numpy(dtype=float)
+    distance = query_result_df["distance_gspphot"].to_numpy(dtype=float)
+    theoretical, actual = utilities.deviation_angles(query_result_df["phot_g_mean_mag"].to_numpy(dtype=float))
+
+    p_min, p_max, _ = utilities.PERIOD_GRID_DAYS
+    index = {
+        "source_id": query_result_df["source_id"].to_numpy(dtype=np.int64),
+        "a_min": utilities.period_to_a(p_min, stellar_mass),
+        "a_max": utilities.period_to_a(p_max, stellar_mass),
+    }
+    for model, deviation_angle in zip(MODELS, (theoretical, actual)):
+        k = utilities.snr1_threshold_constant(stellar_mass, distance, deviation_angle, n_obs)
+        # Stars without a usable threshold sort last and are never returned
+        index[f"k_{model}"] = np.where(np.isfinite(k), k, np.inf)
+    return _sort_models(index)
+
+# Combines the indexes of several parts of a catalog (i.e. the shards of a sharded run) into one
+#   A star present in several parts (listed under two aliases) is kept once, from the first part
+def merge_indexes(indexes):
+    merged = {}
+    source_ids = np.concatenate([index["source_id"] for index in indexes])
+    _, first_rows = np.unique(source_ids, return_index=True)
+    first_rows.sort()
+    for name in ["source_id", "a_min", "a_max"] + [f"k_{model}" for model in MODELS]:
+        merged[name] = np.concatenate([index[name] for index in indexes])[first_rows]
+    return _sort_models(merged)
+
+def _sort_models(index):
+    for model in MODELS:
+        order = np.argsort(index[f"k_{model}"], kind="stable")
+        index[f"order_{model}"] = order
+        index[f"k_sorted_{model}"] = index[f"k_{model}"][order]
+    return index
+
+def save_index(index, path):
+    checkpoint.atomic_savez(path, **index)
+
+def load_index(path):
+    with np.load(path) as index_file:
+        return {name: index_file[name] for name in index_file.files}
+
+# Stars around which a companion of mass_mjup at a_au reaches SNR1 >= 1, most sensitive first
+def query_point(index, mass_mjup, a_au, model="actual", top=None):
+    return query_range(index, mass_mjup, a_au, a_au, model, top)
+
+def query_range(index, mass_mjup, a_min_au, a_max_au, model="actual", top=None):
+    """
+    Stars around which a companion of mass_mjup reaches SNR1 >= 1 somewhere in [a_min_au, a_max_au]
+    (within the star's grid), ranked by the SNR1 at the most favourable semi-major axis.
+    Returns a DataFrame of source_id, best_a_au, threshold_mass_mjup (at best_a_au) and snr1
+    """
+
+    if model not in MODELS:
+        raise ValueError(f"Unknown model {model}; use one of {MODELS}")
+
+    # K <= M * a_max_au is necessary for a detection, and K is sorted: binary search for the bound
+    k_sorted = index[f"k_sorted_{model}"]
+    n_candidates = np.searchsorted(k_sorted, mass_mjup * a_max_au, side="right")
+    candidates = index[f"order_{model}"][:n_candidates]
+
+    # The SNR1 grows with a, so the best semi-major axis is the largest one allowed for the star
+    best_a = np.minimum(a_max_au, index["a_max"][candidates])
+    lowest_a = np.maximum(a_min_au, index["a_min"][candidates])
+    k = index[f"k_{model}"][candidates]
+    detectable = (best_a >= lowest_a) & (k <= mass_mjup * best_a)
+
+    results = pd.DataFrame({
+        "source_id": index["source_id"][candidates][detectable],
+        "best_a_au": best_a[detectable],
+        "threshold_mass_mjup": k[detectable] / best_a[detectable],
+        "snr1": mass_mjup * best_a[detectable] / k[detectable],
+    })
+    results = results.sort_values("snr1", ascending=False, kind="stable", ignore_index=True)
+    return results.head(top) if top else results
+
+# Reads a saved query result (.pkl or .csv), or the query result inside a run directory
+def read_query_results(path):
+    if os.path.isdir(path):
+        path = os.path.join(path, "gaia_query_results.pkl")
+    if path.endswith(".csv"):
+        return pd.read_csv(path)
+    return pd.read_pickle(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("query_results")
+    build_parser.add_argument("-o", "--output", default=INDEX_FILENAME)
+    build_parser.add_argument("--nobs_table")
+    build_parser.add_argument("--dr5", "--DR5", "--Dr5", action="store_true")
+
+    query_parser = subparsers.add_parser("query")
+    query_parser.add_argument("index")
+    query_parser.add_argument("--mass", type=float, required=True)
+    query_parser.add_argument("--a", type=float)
+    query_parser.add_argument("--a_min", type=float)
+    query_parser.add_argument("--a_max", type=float)
+    query_parser.add_argument("--model", choices=MODELS, default="actual")
+    query_parser.add_argument("--top", type=int)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        query_result_df = read_query_results(args.query_results)
+        n_obs = None
+        if args.nobs_table:
+            n_obs = obs_counts.expected_observations(obs_counts.load_table(args.nobs_table),
+                                                     query_result_df["ra"], query_result_df["dec"],
+                                                     "DR5" if args.dr5 else "DR4")
+        save_index(build_index(query_result_df, n_obs), args.output)
+        print(f"Capability index for {len(query_result_df)} stars saved to {args.output}")
+    else:
+        index = load_index(args.index)
+        if args.a is not None:
+            results = query_point(index, args.mass, args.a, args.model, args.top)
+        elif args.a_min is not None and args.a_max is not None:
+            results = query_range(index, args.mass, args.a_min, args.a_max, args.model, args.top)
+        else:
+            parser.error("query needs --a, or --a_min and --a_max")
+        print(results.to_string(index=False))
+        print(f"{len(results)} stars")
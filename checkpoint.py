@@ -0,0 +1,141 @@
+# This file keeps the durable state of a run in a run directory, so a long run that dies midway
+#   (archive timeout, OOM, node preemption) can continue where it stopped with --resume.
+#
+# Layout of a run directory:
+#   run.json                      input IDs, options and chunk sizes of the run
+#   resolved_ids.json             input ID -> Gaia DR3 source_id
+#   gaia_rows/chunk_0000.pkl      fetched Gaia rows, one file per chunk of source_ids (in source_id
+#                                 order, so a chunk covers a narrow range of the catalog)
+#   gaia_query_results.csv/.pkl   cleaned query results
+#   grids/chunk_0000.npz          SNR grids, one file per chunk of stars
+#   plots/, manifest.json         rendered plots and the manifest of what was rendered
+#
+# Every file is written to a temporary name and renamed into place, so a checkpoint is either
+#   complete or absent.
+
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Number of source_ids per Gaia query checkpoint and number of stars per grid checkpoint
+QUERY_CHUNK_SIZE = 1000
+# A local catalog lookup costs little per ID but re-opens the dataset per call, so it takes
+#   much larger chunks than the archive
+LOCAL_QUERY_CHUNK_SIZE = 100000
+GRID_CHUNK_SIZE = 250
+# Longest time between manifest saves while rendering (seconds)
+MANIFEST_SAVE_SECONDS = 10
+
+# Permissions given to written files; mkstemp creates its files readable by the owner only
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Yields a temporary path next to path; the file is renamed to path once the block completes
+#   The temporary name is unique, so concurrent writers (threads, processes, or nodes sharing a
+#   filesystem) never write to the same temporary file
+@contextmanager
+def atomic_path(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Keep the extension, since some writers (np.savez) append their own when it is missing
+    extension = os.path.splitext(path)[1]
+    fd, tmp_path = tempfile.mkstemp(dir=directory or ".", prefix=f"{os.path.basename(path)}.",
+                                    suffix=f".tmp{extension}")
+    os.close(fd)
+    os.chmod(tmp_path, 0o666 & ~_UMASK)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def atomic_write_json(obj, path):
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, "w") as f:
+            json.dump(obj, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+
+def atomic_to_pickle(df, path):
+    with atomic_path(path) as tmp_path:
+        df.to_pickle(tmp_path)
+
+def atomic_to_csv(df, path):
+    with atomic_path(path) as tmp_path:
+        df.to_csv(tmp_path, index=False)
+
+def atomic_savez(path, **arrays):
+    with atomic_path(path) as tmp_path:
+        np.savez(tmp_path, **arrays)
+
+# Checkpoints of one run; with run_dir=None checkpointing is off and nothing is loaded or saved
+#   Existing checkpoints are only loaded when resume is True
+class RunCheckpoints:
+    def __init__(self, run_dir, resume=False):
+        self.run_dir = run_dir
+        self.resume = resume and run_dir is not None
+
+    @property
+    def enabled(self):
+        return self.run_dir is not None
+
+    def path(self, *parts):
+        return os.path.join(self.run_dir, *parts)
+
+    # Records the input and options of the run; a resumed run must match the original
+    def start(self, id_list, options, query_chunk_size=QUERY_CHUNK_SIZE):
+        if not self.enabled:
+            return
+        run_info = {"ids": [str(id_) for id_ in id_list], "options": options,
+                    "query_chunk_size": query_chunk_size, "query_order": "source_id",
+                    "grid_chunk_size": GRID_CHUNK_SIZE}
+        if self.resume and os.path.isfile(self.path("run.json")):
+            with open(self.path("run.json")) as f:
+                previous = json.load(f)
+            if previous != run_info:
+                raise ValueError(f"Cannot resume {self.run_dir}: it was started with different IDs, options or chunk sizes")
+            return
+        atomic_write_json(run_info, self.path("run.json"))
+
+    def load_resolved_ids(self):
+        if not self.resume or not os.path.isfile(self.path("resolved_ids.json")):
+            return None
+        with open(self.path("resolved_ids.json")) as f:
+            return json.load(f)
+
+    def save_resolved_ids(self, id_map):
+        if self.enabled:
+            atomic_write_json(id_map, self.path("resolved_ids.json"))
+
+    def load_gaia_rows(self, chunk_index):
+        path = self.path("gaia_rows", f"chunk_{chunk_index:04d}.pkl") if self.enabled else None
+        if not self.resume or not os.path.isfile(path):
+            return None
+        return pd.read_pickle(path)
+
+    def save_gaia_rows(self, chunk_index, rows_df):
+        if self.enabled:
+            atomic_to_pickle(rows_df, self.path("gaia_rows", f"chunk_{chunk_index:04d}.pkl"))
+
+    # Returns the saved grids of a chunk of stars if they were computed for the same source_ids
+    def load_grids(self, chunk_index, source_ids):
+        path = self.path("grids", f"chunk_{chunk_index:04d}.npz") if self.enabled else None
+        if not self.resume or not os.path.isfile(path):
+            return None
+        grids = dict(np.load(path))
+        if not np.array_equal(grids["source_id"], np.asarray(source_ids, dtype=np.int64)):
+            return None
+        return grids
+
+    # The grids are stored as float32, half the size of the computed float64 grids
+    def save_grids(self, chunk_index, grids):
+        if self.enabled:
+            stored_grids = {name: array.astype(np.float32) if array.dtype.kind == "f" else array
+                            for name, array in grids.items()}
+            atomic_savez(self.path("grids", f"chunk_{chunk_index:04d}.npz"), **stored_grids)
@@ -0,0 +1,74 @@
+# This file answers the Gaia stellar parameter query from a local Parquet extract instead of the
+#   remote Gaia archive, for machines without outbound network access.
+#
+# The extract is the gaiadr3.gaia_source + gaiadr3.astrophysical_parameters join used by
+#   query.gaia_query (same column names; see query.GAIA_QUERY_COLUMNS), stored as either
+#   - one or more Parquet files sorted by source_id, or
+#   - a hive partitioned directory on a HEALPix index, i.e. <catalog>/healpix5=1234/part-0.parquet
+#     The partition level is read from the column name (healpix<level>, nested scheme)
+#
+# Lookups are pushed down into the Parquet reader: row groups whose source_id statistics cannot
+#   match are skipped, HEALPix partitions that hold none of the requested stars are never opened,
+#   and files are memory mapped rather than read into memory.
+
+import re
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs
+
+# Gaia source_ids encode the level 12 nested HEALPix index of the source: source_id // 2**35
+HEALPIX_LEVEL_12_DIVISOR = 2**35
+HEALPIX_PARTITION_PATTERN = re.compile(r"^healpix_?(\d+)$")
+
+# Returns the nested HEALPix index at the given level (0-12) of each Gaia source_id
+def healpix_from_source_id(source_ids, level=12):
+    source_ids = np.asarray(source_ids, dtype=np.int64)
+    return (source_ids // HEALPIX_LEVEL_12_DIVISOR) >> (2 * (12 - level))
+
+def open_catalog(catalog_path):
+    filesystem = pyarrow.fs.LocalFileSystem(use_mmap=True)
+    return ds.dataset(catalog_path, format="parquet", partitioning="hive", filesystem=filesystem)
+
+def local_gaia_query(source_ids, catalog_path, columns):
+    """
+    Returns a DataFrame with the requested columns for the given Gaia DR3 source_ids, read from
+    the local Parquet extract at catalog_path (a file or a directory)
+    """
+
+    source_ids = np.unique(np.asarray(source_ids, dtype=np.int64))
+    dataset = open_catalog(catalog_path)
+
+    missing_columns = [column for column in columns if column not in dataset.schema.names]
+    if missing_columns:
+        raise ValueError(f"Local catalog {catalog_path} is missing columns: {missing_columns}")
+
+    # The range filter lets the reader skip row groups of source_id sorted files from their
+    #   statistics; the membership test selects the exact rows
+    source_id_field = pc.field("source_id")
+    row_filter = ((source_id_field >= pa.scalar(int(source_ids.min()), pa.int64()))
+                  & (source_id_field <= pa.scalar(int(source_ids.max()), pa.int64()))
+                  & source_id_field.isin(pa.array(source_ids, pa.int64())))
+
+    # Prune HEALPix partitions that cannot hold any of the requested stars
+    for name in dataset.schema.names:
+        match = HEALPIX_PARTITION_PATTERN.match(name)
+        if match:
+            pixels = np.unique(healpix_from_source_id(source_ids, int(match.group(1))))
+            partition_type = dataset.schema.field(name).type
+            row_filter = pc.field(name).isin(pa.array(pixels).cast(partition_type)) & row_filter
+            break
+
+    table = dataset.to_table(columns=list(columns), filter=row_filter)
+    results_df = table.to_pandas()
+
+    found = set(results_df["source_id"].tolist())
+    not_found = [int(source_id) for source_id in source_ids if int(source_id) not in found]
+    if not_found:
+        print(f"\nWARNING: {len(not_found)} source_ids were not found in the local catalog:")
+        for source_id in not_found[:20]:
+            print(f"  - {source_id}")
+
+    return results_df
@@ -3,12 +3,17 @@ from html import parser
 import numpy as np
 import os
 import pandas as pd
-import plotting
 import sys
+import time
 
 # Local modules
-import plotting
+import capability_index
+import checkpoint
+import manifest
+import obs_counts
 import query
+import shards
+import summary
 import utilities
 
 ####################
@@ -21,20 +26,39 @@ If the star's ID has special characters in it, place the whole id in quotations:
 Optional flags:
     --dr5      : Calculate based on DR5 observaton timeline (DR4 is default)
     --load_file: Load a previous query result from a .npy file instead of querying again
+    --force    : Re-render every star, even if its inputs are unchanged since the last run
+    --formats  : Comma separated plot formats to write, i.e. --formats png or --formats pdf,png (default pdf,png)
+    --dpi      : Resolution of the written plots (default 600)
+    --rasterize: Embed the filled contours in PDF/SVG output as an image (much smaller files)
+    --thumbnail: Write a single low resolution PNG per plot for quick triage of many stars
+    --multipage_pdf: Write every plot of the run into one multi-page PDF instead of per-star files
+    --contact_sheet: Tile every plot of the run into PNG contact sheets (<prefix>_0001.png, ...) instead of per-star files
+    --sheet_grid   : Layout of each contact sheet as COLUMNSxROWS (default 4x4)
+    --no_known_planets     : Do not query the Exoplanet Archive for known planets to overlay on the plots
+    --refresh_known_planets: Ignore the local known planets cache and query the Exoplanet Archive again
+    --local_catalog: Read stellar parameters from a local Parquet extract of the Gaia catalog instead of the Gaia archive
+    --nobs_table   : Observation count table (see obs_counts.py); scales the SNR by the expected number of Gaia observations of each star
+    --run_dir      : Keep checkpoints, query results, grids, plots and the manifest of the run in this directory
+    --resume       : Continue an interrupted run from the checkpoints in --run_dir
+    --capability_index: Also write a detection-capability index of the processed stars to this .npz file (see capability_index.py)
+    --no_plot      : Headless mode: write only the per-star summary table (see summary.py); matplotlib is never imported
+    --summary      : Write the per-star summary table to this file (.parquet, or .csv); default gaia_summary.parquet with --no_plot
+    --shard        : Process only shard i of N of the input (i.e. --shard 0/4), into its own run directory (see shards.py)
 '''
 ####################
 
-def interpret_user_input():
+# planet_id_args holds the positional arguments only, so optional flags never end up in an ID
+def interpret_user_input(planet_id_args):
     # Variable that tracks the catalog ID type
     cat_id_type = None
     
      # Check if the first argument is a file
     
-    if sys.argv[1].endswith('.txt') or sys.argv[1].endswith('.csv'):
+    if planet_id_args[0].endswith('.txt') or planet_id_args[0].endswith('.csv'):
         # Records if the file is a .txt or a .csv (used for parsing purposes later)
-        file_extension = os.path.splitext(sys.argv[1])[1]
+        file_extension = os.path.splitext(planet_id_args[0])[1]
         print(f"File extension detected: {file_extension}")
-        file_path = sys.argv[1]
+        file_path = planet_id_args[0]
         
         # Sets the catalog ID type to the file extension initially (for later use)
         cat_id_type = file_extension
@@ -83,16 +107,16 @@ def interpret_user_input():
         # Create a dataframe that holds the single planet ID and its catalog type
         id_string = ""
 
-        for arg in sys.argv[1:]:
+        for arg in planet_id_args:
             id_string += arg + " "
 
         planet_ids_df = pd.DataFrame({"ID": [id_string.strip()]})
 
     return planet_ids_df, cat_id_type
 
-def validate_catalog_input():
+def validate_catalog_input(planet_id_args):
 
-    if len(sys.argv) < 2:
+    if len(planet_id_args) < 1:
         raise ValueError("Input too short. Please privde a catalog acronym and ID.")
     else:
         return
@@ -118,6 +142,31 @@ def validate_catalog_input():
     #         "Invalid catalog. Must be one of: Gaia DR3, HD, TIC, or HIP."
     #     )
 
+# Calculates the semi-major axes and SNR1 grids of a chunk of stars as stacked arrays, in the form
+#   they are checkpointed in (see checkpoint.RunCheckpoints.save_grids)
+def compute_chunk_grids(chunk_df, period_conversion_for_sem_maj_calculation, mass_mjup_1D_array, use_n_obs):
+    semi_major_axes, snr_grids_theoretical, snr_grids_actual = [], [], []
+    for star in chunk_df.itertuples(index=False):
+        semi_major_axis_1D_array, snr_grid_theoretical, snr_grid_actual = utilities.star_snr_grids(
+            star.mass_flame,
+            star.distance_gspphot,
+            star.phot_g_mean_mag,
+            period_conversion_for_sem_maj_calculation,
+            mass_mjup_1D_array,
+            int(star.expected_n_obs) if use_n_obs else None)
+        semi_major_axes.append(semi_major_axis_1D_array)
+        snr_grids_theoretical.append(snr_grid_theoretical)
+        snr_grids_actual.append(snr_grid_actual)
+
+    n_grid = (len(chunk_df), len(mass_mjup_1D_array), len(period_conversion_for_sem_maj_calculation))
+    return {
+        "source_id": chunk_df['source_id'].to_numpy(dtype=np.int64),
+        "semi_major_axis_au": np.array(semi_major_axes, dtype=float).reshape(n_grid[0], n_grid[2]),
+        "planet_mass_mjup": mass_mjup_1D_array,
+        "snr_theoretical": np.array(snr_grids_theoretical, dtype=float).reshape(n_grid),
+        "snr_actual": np.array(snr_grids_actual, dtype=float).reshape(n_grid),
+    }
+
 # Main execution
 if __name__ == "__main__":
 
@@ -133,26 +182,131 @@ if __name__ == "__main__":
     # Optional flag that loads a previous query result from a .npy file instead of querying again
     parser.add_argument('--load_file', '--LOAD_FILE', '--Load_File')
 
+    # Optional flag that re-renders every star instead of skipping stars whose inputs are unchanged
+    parser.add_argument('--force', '--FORCE', '--Force', action='store_true')
+
+    # Optional flags that control the written plots: formats, resolution, rasterized contours in
+    #   vector formats, and a low resolution thumbnail mode for bulk triage
+    parser.add_argument('--formats', '--FORMATS', '--Formats', default=None)
+    parser.add_argument('--dpi', '--DPI', '--Dpi', type=int)
+    parser.add_argument('--rasterize', '--RASTERIZE', '--Rasterize', action='store_true')
+    parser.add_argument('--thumbnail', '--THUMBNAIL', '--Thumbnail', action='store_true')
+
+    # Optional batch outputs that collect every plot of the run into a few files instead of a
+    #   directory of files per star
+    parser.add_argument('--multipage_pdf', '--MULTIPAGE_PDF', '--Multipage_Pdf')
+    parser.add_argument('--contact_sheet', '--CONTACT_SHEET', '--Contact_Sheet')
+    parser.add_argument('--sheet_grid', '--SHEET_GRID', '--Sheet_Grid')
+
+    # Optional flags for the known planet overlay; planets for every star of the run are fetched
+    #   with one batched, locally cached Exoplanet Archive lookup
+    parser.add_argument('--no_known_planets', '--NO_KNOWN_PLANETS', '--No_Known_Planets', action='store_true')
+    parser.add_argument('--refresh_known_planets', '--REFRESH_KNOWN_PLANETS', '--Refresh_Known_Planets',
+                        action='store_true')
+
+    # Optional local Parquet extract of the Gaia catalog to use instead of the remote archive
+    parser.add_argument('--local_catalog', '--LOCAL_CATALOG', '--Local_Catalog')
+
+    # Optional observation count table for the N_obs-aware SNR mode
+    parser.add_argument('--nobs_table', '--NOBS_TABLE', '--Nobs_Table')
+
+    # Optional run directory with durable checkpoints after each stage and chunk, and the flag that
+    #   continues an interrupted run from them
+    parser.add_argument('--run_dir', '--RUN_DIR', '--Run_Dir')
+    parser.add_argument('--resume', '--RESUME', '--Resume', action='store_true')
+
+    # Optional detection-capability index of the processed stars, queryable with capability_index.py
+    parser.add_argument('--capability_index', '--CAPABILITY_INDEX', '--Capability_Index')
+
+    # Optional per-star summary table, and the headless mode that writes only that table
+    parser.add_argument('--summary', '--SUMMARY', '--Summary')
+    parser.add_argument('--no_plot', '--no-plot', '--NO_PLOT', '--No_Plot', action='store_true')
+
+    # Optional shard of the input (i/N) for runs spread over several processes or nodes
+    parser.add_argument('--shard', '--SHARD', '--Shard')
+
     # Collect the parsed arguments
     args = parser.parse_args()
 
+    # Plotting runs import plotting (and matplotlib) here and check the requested plot formats
+    #   before any archive query is made; headless runs never load matplotlib
+    if not args.no_plot:
+        import plotting
+        output_formats = [f.strip().lower() for f in (args.formats or ','.join(plotting.DEFAULT_OUTPUT_FORMATS)).split(',')
+                          if f.strip()]
+        unsupported_formats = [f for f in output_formats if f not in plotting.SUPPORTED_FORMATS]
+        if not output_formats or unsupported_formats:
+            print(f"ERROR: Invalid --formats {args.formats!r}; supported formats are "
+                  f"{', '.join(plotting.SUPPORTED_FORMATS)}")
+            sys.exit(1)
+
+    # Shard mode: every output goes into the shard's own run directory, including relative paths
+    #   given for the single-file outputs, so concurrent shards never write the same file
+    shard = None
+    if args.shard:
+        try:
+            shard = shards.parse_shard(args.shard)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+        args.run_dir = args.run_dir or shards.shard_run_dir(*shard)
+        for option in ('capability_index', 'summary', 'multipage_pdf', 'contact_sheet'):
+            if getattr(args, option):
+                setattr(args, option, os.path.join(args.run_dir, getattr(args, option)))
+        print(f"Shard {shard[0]} of {shard[1]}; outputs in {args.run_dir}")
+
+    if args.resume and not args.run_dir:
+        print("ERROR: --resume requires --run_dir")
+        sys.exit(1)
+    checkpoints = checkpoint.RunCheckpoints(args.run_dir, resume=args.resume)
+    output_dir = args.run_dir or '.'
+    # Options that change the checkpointed rows and grids; a resumed run must use the same ones
+    checkpoint_options = {"data_release": 'DR5' if args.dr5 else 'DR4',
+                          "local_catalog": args.local_catalog,
+                          "nobs_table": args.nobs_table,
+                          "load_file": args.load_file,
+                          "shard": args.shard}
+
     # If the user has specified to load a previous query result from a .npy file, load
     #   the file instead of querying
     if args.load_file:
         print("Loading previous query result from file: ", args.load_file)
-        # Load the previous query result from a .npy file
+        # Load the previous query result from a .pkl file (or an older .npy file)
         try:
-            loaded_data = np.load("exoplanet_query_results.npy", allow_pickle=True)
-            query_result_df = pd.DataFrame(loaded_data.tolist())
-            print("Loaded query result from exoplanet_query_results.npy:")
+            if args.load_file.endswith('.npy'):
+                loaded_data = np.load(args.load_file, allow_pickle=True)
+                query_result_df = pd.DataFrame(loaded_data.tolist())
+            else:
+                query_result_df = pd.read_pickle(args.load_file)
+            if shard is not None:
+                query_result_df = query_result_df[shards.in_shard(query_result_df['source_id'], *shard)]
+            print(f"Loaded query result from {args.load_file}:")
             print(query_result_df)
+            checkpoints.start(query_result_df['source_id'].tolist(), checkpoint_options)
         except Exception as e:
             print(f"Error loading file: {e}")
             sys.exit(1)
 
+        # Keep the (shard's) query results in the run directory too, as a queried run does, so the
+        #   directory is complete for capability_index.py and shards.py merge
+        if args.run_dir:
+            checkpoint.atomic_to_csv(query_result_df, os.path.join(output_dir, "gaia_query_results.csv"))
+            checkpoint.atomic_to_pickle(query_result_df, os.path.join(output_dir, "gaia_query_results.pkl"))
+            print(f"Query results saved to {output_dir}")
+
     # Interpret the command line arguments to obtain planet IDs and the catalog ID type
     else:
-        planet_ids, cat_id_type = interpret_user_input()
+        if not args.planet_ids:
+            print(USAGE_ERROR_MESSAGE)
+            sys.exit(1)
+
+        planet_ids, cat_id_type = interpret_user_input(args.planet_ids)
+        if shard is not None:
+            planet_ids = planet_ids[shards.in_shard(planet_ids['ID'], *shard)]
+            print(f"{len(planet_ids)} IDs in shard {shard[0]} of {shard[1]}")
+            if planet_ids.empty:
+                print("No IDs fall in this shard; nothing to do.")
+                sys.exit(0)
 
         # Check that one of the appropriate catalog acronyms is in the sys.argv if the cat_id_type is single
 
@@ -161,93 +315,58 @@ if __name__ == "__main__":
         try:
             if cat_id_type == 'single':
                 # Check that sys.argv[1] is an acceptable catalog acronym for simbad to locate
-                validate_catalog_input()
+                validate_catalog_input(args.planet_ids)
 
         except ValueError:
             print("Error determining ID. Please ensure you provide a valid ID.")
             print(USAGE_ERROR_MESSAGE)
             sys.exit(1)
 
+        # Resolve the IDs to Gaia DR3 source_ids (checkpointed), then fetch the Gaia rows in
+        #   chunks, checkpointing each chunk; with --resume, completed stages and chunks are loaded
+        id_list = planet_ids['ID'].tolist()
+        query_chunk_size = checkpoint.LOCAL_QUERY_CHUNK_SIZE if args.local_catalog else checkpoint.QUERY_CHUNK_SIZE
         try:
-            returned_query = query.gaia_query(planet_ids, data_release='DR5' if args.dr5 else 'DR4')
-        except ValueError:
+            checkpoints.start(id_list, checkpoint_options, query_chunk_size)
+            gaia_dr3_id_map = checkpoints.load_resolved_ids()
+            if gaia_dr3_id_map is None:
+                gaia_dr3_id_map = query.resolve_gaia_ids(id_list)
+                checkpoints.save_resolved_ids(gaia_dr3_id_map)
+            else:
+                print(f"Resumed resolved IDs from {args.run_dir}")
+            # Chunk in source_id order: a chunk then covers a narrow source_id range (and nearby
+            #   HEALPix pixels), so a local catalog lookup skips most row groups and partitions
+            gaia_dr3_ids = sorted(query.check_resolved_ids(gaia_dr3_id_map).values(), key=int)
+        except ValueError as e:
+            print(e)
             print(USAGE_ERROR_MESSAGE)
             sys.exit(1)
 
-        # QUERY QUALITY CHECKS
-        # If distance is missing, check if parallax is viable (S/N > 10) and use that to estimate distance
-        returned_query["distance_estimated_flag"] = 0
-        snr_parallax = returned_query['parallax'] / returned_query['parallax_error']
-
-
-        distance_mask = (
-            returned_query["distance_gspphot"].isna() &
-            returned_query["parallax"].notna() &
-            returned_query["parallax_error"].notna() &
-            (returned_query["parallax"] > 0) &
-            (snr_parallax >= 10)
-        )
-
-        returned_query.loc[distance_mask, "distance_gspphot"] = (
-            (1000.0 / returned_query.loc[distance_mask, "parallax"])
-            .astype("float32")
-        )
-        returned_query.loc[distance_mask, "distance_estimated_flag"] = 1
-        print(f"Estimated distances for {distance_mask.sum()} stars (parallax S/N >= 10).")
-        
-        # If stellar mass is missing, use color and abs mag to estimate stellar type and then mass (this is a very rough estimate and can be improved in the future by using isochrones or something similar)
-        #    - this is a very rough estimate and can be improved in the future
-        returned_query["st_mass_estimated_flag"] = 0
-        st_mass_mask = (
-            returned_query["mass_flame"].isna() &
-            returned_query["phot_g_mean_mag"].notna() &
-            returned_query["phot_bp_mean_mag"].notna() &
-            returned_query["phot_rp_mean_mag"].notna() &
-            returned_query["distance_gspphot"].notna()
-        )
-        returned_query.loc[st_mass_mask, "mass_flame"] = utilities.estimate_stellar_mass(
-            returned_query.loc[st_mass_mask, "phot_g_mean_mag"],
-            returned_query.loc[st_mass_mask, "phot_bp_mean_mag"],
-            returned_query.loc[st_mass_mask, "phot_rp_mean_mag"],
-            returned_query.loc[st_mass_mask, "distance_gspphot"]
-        )
-        returned_query.loc[st_mass_mask, "st_mass_estimated_flag"] = 1
-        print(f"Estimated stellar masses for {st_mass_mask.sum()} stars based on color and absolute magnitude.")
-
-        # Find any rows with NaNs
-        # Find rows with NaNs in mass_flame or distance_gspphot (the two most important parameters for the astrometric signature calculation) and print out which columns are missing for each row; then drop those rows for the rest of the analysis for now (but save them in a separate dataframe and print them out so we can see how many and which rows are being dropped and what info is missing for those rows)
-        nan_rows = returned_query[returned_query[['mass_flame', 'distance_gspphot']].isna().any(axis=1)]
-        missing_info = nan_rows.apply(lambda row: [col for col in ['mass_flame', 'distance_gspphot'] if pd.isna(row[col])], axis=1)
-        nan_rows = nan_rows.assign(missing_info=missing_info)
-        # For now, just drop the rows that contain an NaN
-        clean_df = returned_query.dropna(subset=['mass_flame', 'distance_gspphot'])
-
-        # Print the nan_rows dataframe without the columns information after the analysis to avoid cluttering the output
-        if not nan_rows.empty:
-            print(f"\n{len(nan_rows)} rows contain NaN values in mass_flame or distance_gspphot and will be dropped from the analysis:")
-            print(nan_rows.drop(columns=['missing_info']))
-            print("\nThe following columns are missing for each of these rows:")
-            for index, row in nan_rows.iterrows():
-                print(f"Row {index}: Missing {row['missing_info']}")
-        else:
-            print("\nNo rows contain NaN values in mass_flame or distance_gspphot.")
-
-        # Possible way to estimate distance if missing, before checking for NaN rows
-        #    - may want to only do this for rows with a certain S/N for the parallax measurement (>10?)
-        # returned_query.fillna({'distance_gspphot': 1000.0 / df['parallax']})
+        gaia_rows = []
+        for chunk_index, chunk_start in enumerate(range(0, len(gaia_dr3_ids), query_chunk_size)):
+            chunk_rows = checkpoints.load_gaia_rows(chunk_index)
+            if chunk_rows is None:
+                chunk_rows = query.fetch_gaia_rows(gaia_dr3_ids[chunk_start:chunk_start + query_chunk_size],
+                                                   local_catalog_path=args.local_catalog)
+                checkpoints.save_gaia_rows(chunk_index, chunk_rows)
+            gaia_rows.append(chunk_rows)
+        returned_query = pd.concat(gaia_rows, ignore_index=True)
+
+        # QUERY QUALITY CHECKS; estimate missing distances and masses, drop stars that still lack them
+        clean_df = query.clean_query_results(returned_query)
 
         # Save the queried data to a CSV file and a pickled .npy file
-        output_csv_filename = "gaia_query_results.csv"
-        clean_df.to_csv(output_csv_filename, index=False)
+        output_csv_filename = os.path.join(output_dir, "gaia_query_results.csv")
+        checkpoint.atomic_to_csv(clean_df, output_csv_filename)
         print(f"Query results saved to {output_csv_filename}")
-        output_npy_filename = "gaia_query_results.pkl"
-        clean_df.to_pickle(output_npy_filename)
+        output_npy_filename = os.path.join(output_dir, "gaia_query_results.pkl")
+        checkpoint.atomic_to_pickle(clean_df, output_npy_filename)
         print(f"Query results saved to {output_npy_filename}")
         
         # Load the data back from the .npy file to verify saving worked and fit in
         #   with the work flow of loading a previous query result
-        query_result_df = pd.read_pickle("gaia_query_results.pkl")
-        print("Loaded query result from gaia_query_results.pkl:")
+        query_result_df = pd.read_pickle(output_npy_filename)
+        print(f"Loaded query result from {output_npy_filename}:")
         print(query_result_df)
 
 
@@ -261,51 +380,176 @@ if __name__ == "__main__":
     # Calculate P^2/3) for teh sem_maj_axis calculation
     period_conversion_for_sem_maj_calculation = (period_days_1D_array/365.25)**(2/3)
 
-    # Thus begins the for loop iterationg through the queried stellar data
+    # N_obs-aware SNR mode: look up the expected number of observations of every star at once
+    #   from the sky-indexed observation count table
+    if args.nobs_table:
+        nobs_table = obs_counts.load_table(args.nobs_table)
+        query_result_df = query_result_df.assign(expected_n_obs=obs_counts.expected_observations(
+            nobs_table, query_result_df['ra'], query_result_df['dec'], 'DR5' if args.dr5 else 'DR4'))
+        print(f"Expected observations per star from {args.nobs_table}: "
+              f"{query_result_df['expected_n_obs'].min()} to {query_result_df['expected_n_obs'].max()}")
+
+    # Detection-capability index of every processed star, built in one vectorized pass
+    if args.capability_index:
+        n_obs = query_result_df['expected_n_obs'].to_numpy() if args.nobs_table else None
+        capability_index.save_index(capability_index.build_index(query_result_df, n_obs), args.capability_index)
+        print(f"Capability index for {len(query_result_df)} stars saved to {args.capability_index}")
+
+    # Per-star summary table, computed for every star at once from the closed form of the SNR1 = 1
+    #   line; in --no_plot mode this is the only output, and the run ends here
+    summary_filename = args.summary or (os.path.join(output_dir, summary.SUMMARY_FILENAME) if args.no_plot else None)
+    if summary_filename:
+        n_obs = query_result_df['expected_n_obs'].to_numpy() if args.nobs_table else None
+        summary.save_summary(summary.summary_table(query_result_df, n_obs), summary_filename)
+        print(f"Summary of {len(query_result_df)} stars saved to {summary_filename}")
+    if args.no_plot:
+        sys.exit(0)
+
+    # Directory of the per-star plots; kept out of plot_options, so moving a run directory (or
+    #   merging shards) does not change the manifest fingerprints
+    plot_dir = os.path.join(args.run_dir, "plots") if args.run_dir else "plots"
+
+    # Plot output settings; thumbnail mode overrides the formats and resolution with a single low
+    #   resolution PNG per plot
+    if args.thumbnail:
+        plot_options = {"output_formats": list(plotting.THUMBNAIL_FORMATS),
+                        "dpi": args.dpi or plotting.THUMBNAIL_DPI,
+                        "rasterize_contours": False}
+    else:
+        plot_options = {"output_formats": output_formats,
+                        "dpi": args.dpi or plotting.DEFAULT_DPI,
+                        "rasterize_contours": args.rasterize}
+
+    # Open the batch outputs, if requested; these hold every star of the run, so all stars are
+    #   rendered into them and per-star files are not written
+    batch_mode = bool(args.multipage_pdf or args.contact_sheet)
+    multipage_pdf = plotting.open_multipage_pdf(args.multipage_pdf) if args.multipage_pdf else None
+    contact_sheet = None
+    if args.contact_sheet:
+        sheet_grid = args.sheet_grid or f'{plotting.CONTACT_SHEET_COLUMNS}x{plotting.CONTACT_SHEET_ROWS}'
+        try:
+            sheet_columns, sheet_rows = (int(n) for n in sheet_grid.lower().split('x'))
+        except ValueError:
+            print(f"ERROR: Invalid --sheet_grid {sheet_grid}; expected COLUMNSxROWS, i.e. 4x4")
+            sys.exit(1)
+        contact_sheet = plotting.ContactSheet(args.contact_sheet, columns=sheet_columns, rows=sheet_rows)
+
+    # Look up the known planets around every star of the run at once, keyed by Gaia DR3 source_id
+    if args.no_known_planets:
+        known_planets_by_star = {}
+    else:
+        known_planets_by_star = query.known_planets_query(query_result_df['source_id'].tolist(),
+                                                          refresh=args.refresh_known_planets)
+
+    # Load the manifest of previously rendered stars; stars whose inputs are unchanged since the
+    #   last run are skipped unless --force is given. In a run directory, the recorded plot paths
+    #   are relative to the run directory
+    run_settings = manifest.run_settings('DR5' if args.dr5 else 'DR4', plot_options)
+    manifest_filename = os.path.join(args.run_dir, "manifest.json") if args.run_dir else manifest.MANIFEST_FILENAME
+    plot_manifest = manifest.load_manifest(manifest_filename)
+    skipped_count = 0
+    last_manifest_save = time.monotonic()
+
+    # Thus begins the for loop iterationg through the queried stellar data in chunks; the grids of
+    #   each chunk are checkpointed, and the manifest is saved after each chunk so an interrupted
+    #   run resumes after the last rendered chunk
     # Contains the plotting functionality
     print("PLOTTING...")
-    for star in query_result_df.itertuples(index=False):
-        
-        semi_major_axis_1D_array = utilities.semi_maj_axis_conversion(period_conversion_for_sem_maj_calculation, star.mass_flame)
-
-        # Calculate the astrometric signaure grids for the queried exoplanet data
-        astrometric_signature_grid = utilities.astrometric_signature_grid(star.mass_flame,
-                                                                          star.distance_gspphot,
-                                                                          semi_major_axis_1D_array,
-                                                                          mass_mjup_1D_array)
-    
-        # THINK OF A TEST TO MAKE SURE THIS CALCULATION IS WORKING AS EXPECTED
-
-        # Calculate the SNR1 values for each of the astrometric signaure values based on the star's
-        #   g-magnitude
-        snr_grid_theoretical, snr_grid_actual = utilities.snr_grid(astrometric_signature_grid,
-                                                                   star.phot_g_mean_mag) 
-
-        # Call the plotting functionality to make the sensitivity plots
-        # TO DO:
-        known_planets = None # declared for method purposes
-        #   - add known planets functionality
-        #   - query exoplanet archive for known planet information for the star and add to the plot
-        # known_planets = [(0.349, 3.02),(1.152, 9.27)] # (AU, M_jup) for TOI-4600 b and c )not detectable)
-        # known_planets = [(0.03, 0.024),(13.183, 5.909)] # for HD 155918 super jupiter (not detectable) GDR3 ID 5801950515627094400
-        # known_planets = [(3.233, 24.128), (2.325, 22.609)] # for 2 planets around HD 81817 MISSING SOL MASS IN GAIA DATABASE
-        # known_planets = [(0.073, 0.0387), (1.37, 7.6802)] # for TOI-1736 b and c (c is detectable) GDR3 ID 541725187117160960
-        
-        plotting.plot_snr_1_grid(semi_major_axis_1D_array,
-                                  mass_mjup_1D_array,
-                                  snr_grid_theoretical,
-                                  title_suffix="Theoretical Deviation Angle",
-                                  star_name=star.source_id,
-                                  g_magnitude=star.phot_g_mean_mag,
-                                  distance_pc=star.distance_gspphot,
-                                  stellar_mass_solar=star.mass_flame,
-                                  known_planets=known_planets)
-        plotting.plot_snr_1_grid(semi_major_axis_1D_array,
-                                  mass_mjup_1D_array,
-                                  snr_grid_actual,
-                                  title_suffix="Actual Deviation Angle",
-                                  star_name=star.source_id,
-                                  g_magnitude=star.phot_g_mean_mag,
-                                  distance_pc=star.distance_gspphot,
-                                  stellar_mass_solar=star.mass_flame,
-                                  known_planets=known_planets)
\ No newline at end of file
+    try:
+        for chunk_index, chunk_start in enumerate(range(0, len(query_result_df), checkpoint.GRID_CHUNK_SIZE)):
+            chunk_df = query_result_df.iloc[chunk_start:chunk_start + checkpoint.GRID_CHUNK_SIZE]
+            chunk_grids = checkpoints.load_grids(chunk_index, chunk_df['source_id'])
+            if chunk_grids is None:
+                chunk_grids = compute_chunk_grids(chunk_df, period_conversion_for_sem_maj_calculation,
+                                                  mass_mjup_1D_array, args.nobs_table is not None)
+                checkpoints.save_grids(chunk_index, chunk_grids)
+
+            for star_index, star in enumerate(chunk_df.itertuples(index=False)):
+
+                # Known planets as (AU, M_jup) to overlay on the plots; None if there are none
+                known_planets = known_planets_by_star.get(int(star.source_id)) or None
+
+                # Expected number of observations in N_obs-aware mode; None for the single-epoch SNR
+                n_obs = int(star.expected_n_obs) if args.nobs_table else None
+
+                star_fingerprint = manifest.star_fingerprint(star, run_settings, known_planets)
+                if not (args.force or batch_mode) and manifest.is_up_to_date(plot_manifest, star.source_id, star_fingerprint, args.run_dir):
+                    skipped_count += 1
+                    continue
+
+                # The star's semi-major axes and SNR1 grids (theoretical and actual deviation angle)
+                semi_major_axis_1D_array = chunk_grids["semi_major_axis_au"][star_index]
+                snr_grid_theoretical = chunk_grids["snr_theoretical"][star_index]
+                snr_grid_actual = chunk_grids["snr_actual"][star_index]
+
+                # Batch mode: stream both plots into the multi-page PDF and/or contact sheet
+                if batch_mode:
+                    for title_suffix, grid in (("Theoretical Deviation Angle", snr_grid_theoretical),
+                                               ("Actual Deviation Angle", snr_grid_actual)):
+                        fig = plotting.build_snr_1_figure(semi_major_axis_1D_array,
+                                                          mass_mjup_1D_array,
+                                                          grid,
+                                                          title_suffix=title_suffix,
+                                                          star_name=star.source_id,
+                                                          g_magnitude=star.phot_g_mean_mag,
+                                                          distance_pc=star.distance_gspphot,
+                                                          stellar_mass_solar=star.mass_flame,
+                                                          known_planets=known_planets,
+                                                          rasterize_contours=plot_options["rasterize_contours"],
+                                                          n_obs=n_obs)
+                        if multipage_pdf is not None:
+                            multipage_pdf.savefig(fig, dpi=plot_options["dpi"])
+                        if contact_sheet is not None:
+                            contact_sheet.add(fig)
+                    continue
+
+                output_paths = plotting.plot_snr_1_grid(semi_major_axis_1D_array,
+                                          mass_mjup_1D_array,
+                                          snr_grid_theoretical,
+                                          title_suffix="Theoretical Deviation Angle",
+                                          star_name=star.source_id,
+                                          g_magnitude=star.phot_g_mean_mag,
+                                          distance_pc=star.distance_gspphot,
+                                          stellar_mass_solar=star.mass_flame,
+                                          known_planets=known_planets,
+                                          n_obs=n_obs,
+                                          plot_dir=plot_dir,
+                                          **plot_options)
+                output_paths += plotting.plot_snr_1_grid(semi_major_axis_1D_array,
+                                          mass_mjup_1D_array,
+                                          snr_grid_actual,
+                                          title_suffix="Actual Deviation Angle",
+                                          star_name=star.source_id,
+                                          g_magnitude=star.phot_g_mean_mag,
+                                          distance_pc=star.distance_gspphot,
+                                          stellar_mass_solar=star.mass_flame,
+                                          known_planets=known_planets,
+                                          n_obs=n_obs,
+                                          plot_dir=plot_dir,
+                                          **plot_options)
+
+                manifest.record(plot_manifest, star.source_id, star_fingerprint, output_paths, args.run_dir)
+
+                # Save the manifest regularly within a chunk too, so little rendering is repeated on resume
+                if time.monotonic() - last_manifest_save > checkpoint.MANIFEST_SAVE_SECONDS:
+                    manifest.save_manifest(plot_manifest, manifest_filename)
+                    last_manifest_save = time.monotonic()
+
+            # Batch mode renders every star and records nothing in the manifest
+            if not batch_mode:
+                manifest.save_manifest(plot_manifest, manifest_filename)
+                last_manifest_save = time.monotonic()
+    finally:
+        # Close the batch outputs even if rendering fails, so they are always complete files
+        if multipage_pdf is not None:
+            multipage_pdf.close()
+        if contact_sheet is not None:
+            sheet_paths = contact_sheet.close()
+
+    if multipage_pdf is not None:
+        print(f"Plots saved to {args.multipage_pdf}")
+    if contact_sheet is not None:
+        print(f"Plots saved to {len(sheet_paths)} contact sheet(s): {args.contact_sheet}_*.png")
+
+    if skipped_count:
+        print(f"Skipped {skipped_count} stars whose inputs are unchanged since the last run (use --force to re-render).")
@@ -0,0 +1,91 @@
+# This file keeps a manifest of the plots produced for each star so that repeated runs only
+#   recompute and re-render the stars whose inputs changed since the previous run.
+#
+# Each star is fingerprinted with a hash of everything that goes into its plots: the stellar
+#   parameters used in the calculation, the data release, the period/mass grid, the deviation
+#   angle model and the plot output settings. If the fingerprint matches the manifest entry and
+#   every file recorded for the star still exists, the star is skipped.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import checkpoint
+import utilities
+
+MANIFEST_FILENAME = "plots/manifest.json"
+
+# Query columns that feed into a star's grids and plot annotations
+STAR_INPUT_COLUMNS = ["source_id", "mass_flame", "distance_gspphot", "phot_g_mean_mag"]
+# Columns that only exist in some modes (i.e. expected_n_obs with an observation count table)
+OPTIONAL_STAR_INPUT_COLUMNS = ["expected_n_obs"]
+
+# Fingerprint of the deviation angle model; the model is sampled across the G-magnitude range so
+#   that any change to the fits in utilities (THEORETICAL/ACTUAL_DEVIATION_ANGLE_FIT) changes the hash
+def deviation_angle_model_fingerprint():
+    samples = [utilities.assign_deviation_angles(mag) for mag in np.arange(3.0, 21.0, 0.25)]
+    return _hash(samples)
+
+# Settings shared by every star in a run; anything that changes the plots but is not a property
+#   of the individual star belongs here
+#   plot_options are the output settings passed through to plotting.plot_snr_1_grid
+def run_settings(data_release, plot_options):
+    return {
+        "data_release": data_release,
+        "grid": utilities.grid_spec(),
+        "deviation_angle_model": deviation_angle_model_fingerprint(),
+        "plot_options": dict(plot_options),
+    }
+
+# Hash of a single star's inputs combined with the run settings
+#   known_planets is the overlay drawn on the star's plots, if any
+def star_fingerprint(star, settings, known_planets=None):
+    star_inputs = {column: _plain(getattr(star, column)) for column in STAR_INPUT_COLUMNS}
+    for column in OPTIONAL_STAR_INPUT_COLUMNS:
+        if hasattr(star, column):
+            star_inputs[column] = _plain(getattr(star, column))
+    star_inputs["known_planets"] = sorted(known_planets) if known_planets else None
+    return _hash({"star": star_inputs, "settings": settings})
+
+def load_manifest(path=MANIFEST_FILENAME):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print(f"WARNING: Could not read manifest {path}; all stars will be rebuilt.")
+        return {}
+
+# Written atomically so an interrupted run never leaves a half-written manifest behind
+def save_manifest(manifest, path=MANIFEST_FILENAME):
+    checkpoint.atomic_write_json(manifest, path)
+
+# A star is up to date if its fingerprint is unchanged and all of its recorded outputs exist
+#   base_dir: directory the recorded output paths are relative to (i.e. a run directory, so the
+#   directory can be moved); None for paths relative to the working directory
+def is_up_to_date(manifest, source_id, fingerprint, base_dir=None):
+    entry = manifest.get(str(source_id))
+    if entry is None or entry.get("fingerprint") != fingerprint:
+        return False
+    outputs = entry.get("outputs", [])
+    return len(outputs) > 0 and all(os.path.isfile(os.path.join(base_dir or "", path)) for path in outputs)
+
+def record(manifest, source_id, fingerprint, outputs, base_dir=None):
+    if base_dir is not None:
+        outputs = [os.path.relpath(path, base_dir) for path in outputs]
+    manifest[str(source_id)] = {"fingerprint": fingerprint, "outputs": list(outputs)}
+
+# Convert numpy scalars to plain python values so they serialize consistently
+def _plain(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+def _hash(obj):
+    encoded = json.dumps(obj, sort_keys=True, default=_plain).encode()
+    return hashlib.sha256(encoded).hexdigest()
@@ -0,0 +1,153 @@
+# This file builds and reads a sky-indexed table of the expected number of Gaia observations
+#   (matched transits) per star for DR4 and DR5, used by the N_obs-aware SNR mode.
+#
+# The table is built once from a catalog with DR3 matched_transits (a local Parquet extract, see
+#   local_catalog.py, or saved query results): DR3 counts are averaged per HEALPix pixel and scaled
+#   by the ratio of the DR4/DR5 observing baselines to the DR3 baseline. Gaia's scanning law makes
+#   the number of transits a smooth function of sky position, so the per-pixel average is a good
+#   estimate for any star in the pixel.
+#
+# Storage: a (2, 12 * nside**2) uint16 array saved with np.save (row 0 DR4, row 1 DR5, nested
+#   pixel order); ~100 kB at nside=64. It is memory mapped when read, and a lookup is one index
+#   computation per star.
+#
+# Build:  python obs_counts.py build gaia_extract/ -o obs_counts.npy [--nside 64]
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import local_catalog
+
+# Length of the observing period covered by each data release (months)
+RELEASE_BASELINE_MONTHS = {"DR3": 34, "DR4": 66, "DR5": 126}
+# Releases stored in the table, in row order
+TABLE_RELEASES = ("DR4", "DR5")
+
+DEFAULT_NSIDE = 64
+OBS_COUNTS_COLUMNS = ["ra", "dec", "matched_transits"]
+
+# Nested HEALPix pixel index of each (ra, dec) in degrees; nside must be a power of 2
+def ang2pix_nest(nside, ra_deg, dec_deg):
+    ra = np.radians(np.asarray(ra_deg, dtype=float))
+    z = np.sin(np.radians(np.asarray(dec_deg, dtype=float)))
+    ra, z = np.broadcast_arrays(ra, z)
+    z_abs = np.abs(z)
+    tt = np.mod(ra, 2 * np.pi) / (np.pi / 2)  # in [0, 4)
+
+    face = np.empty(z.shape, dtype=np.int64)
+    ix = np.empty(z.shape, dtype=np.int64)
+    iy = np.empty(z.shape, dtype=np.int64)
+
+    # Equatorial region
+    equatorial = z_abs <= 2 / 3
+    temp1 = nside * (0.5 + tt[equatorial])
+    temp2 = nside * z[equatorial] * 0.75
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp = jp // nside
+    ifm = jm // nside
+    face[equatorial] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[equatorial] = jm & (nside - 1)
+    iy[equatorial] = nside - (jp & (nside - 1)) - 1
+
+    # Polar caps
+    polar = ~equatorial
+    ntt = np.minimum(tt[polar].astype(np.int64), 3)
+    tp = tt[polar] - ntt
+    tmp = nside * np.sqrt(3 * (1 - z_abs[polar]))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z[polar] >= 0
+    face[polar] = np.where(north, ntt, ntt + 8)
+    ix[polar] = np.where(north, nside - jm - 1, jp)
+    iy[polar] = np.where(north, nside - jp - 1, jm)
+
+    return face * nside * nside + _interleave_bits(ix) + (_interleave_bits(iy) << 1)
+
+# Spreads the bits of x so that bit i moves to bit 2i
+def _interleave_bits(x):
+    x = x.astype(np.uint64)
+    result = np.zeros_like(x)
+    for bit in range(32):
+        result |= ((x >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit)
+    return result.astype(np.int64)
+
+def build_table(ra_deg, dec_deg, matched_transits, nside=DEFAULT_NSIDE):
+    """
+    Returns the (len(TABLE_RELEASES), 12 * nside**2) uint16 table of expected transit counts from
+    DR3 positions and matched_transits
+    """
+
+    ra_deg = np.asarray(ra_deg, dtype=float)
+    dec_deg = np.asarray(dec_deg, dtype=float)
+    matched_transits = np.asarray(matched_transits, dtype=float)
+    valid = np.isfinite(ra_deg) & np.isfinite(dec_deg) & np.isfinite(matched_transits)
+    if not valid.any():
+        raise ValueError("No stars with ra, dec and matched_transits to build the table from")
+
+    npix = 12 * nside * nside
+    pixels = ang2pix_nest(nside, ra_deg[valid], dec_deg[valid])
+    counts = np.bincount(pixels, minlength=npix)
+    sums = np.bincount(pixels, weights=matched_transits[valid], minlength=npix)
+
+    # Pixels without any stars get the all-sky median
+    dr3_transits = np.full(npix, np.median(matched_transits[valid]))
+    filled = counts > 0
+    dr3_transits[filled] = sums[filled] / counts[filled]
+
+    table = np.empty((len(TABLE_RELEASES), npix), dtype=np.uint16)
+    for row, release in enumerate(TABLE_RELEASES):
+        scale = RELEASE_BASELINE_MONTHS[release] / RELEASE_BASELINE_MONTHS["DR3"]
+        table[row] = np.clip(np.rint(dr3_transits * scale), 1, np.iinfo(np.uint16).max)
+    return table
+
+def save_table(table, path):
+    tmp_path = f"{path}.tmp.npy"
+    np.save(tmp_path, table)
+    os.replace(tmp_path, path)
+
+# Memory maps a table written by save_table
+def load_table(path):
+    table = np.load(path, mmap_mode="r")
+    if table.ndim != 2 or table.shape[0] != len(TABLE_RELEASES):
+        raise ValueError(f"{path} is not an observation count table")
+    return table
+
+def table_nside(table):
+    return int(round(np.sqrt(table.shape[1] / 12)))
+
+# Expected number of observations for each (ra, dec) in the given data release
+def expected_observations(table, ra_deg, dec_deg, data_release):
+    pixels = ang2pix_nest(table_nside(table), ra_deg, dec_deg)
+    return np.asarray(table[TABLE_RELEASES.index(data_release)][pixels], dtype=np.int64)
+
+# Reads ra, dec and matched_transits from a Parquet extract (file or directory) or a saved query
+#   result (.csv or .pkl)
+def read_catalog_columns(catalog_path):
+    if catalog_path.endswith(".csv"):
+        catalog_df = pd.read_csv(catalog_path, usecols=OBS_COUNTS_COLUMNS)
+    elif catalog_path.endswith(".pkl"):
+        catalog_df = pd.read_pickle(catalog_path)[OBS_COUNTS_COLUMNS]
+    else:
+        catalog_df = local_catalog.open_catalog(catalog_path).to_table(columns=OBS_COUNTS_COLUMNS).to_pandas()
+    return catalog_df["ra"].to_numpy(), catalog_df["dec"].to_numpy(), catalog_df["matched_transits"].to_numpy()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("catalog")
+    build_parser.add_argument("-o", "--output", default="obs_counts.npy")
+    build_parser.add_argument("--nside", type=int, default=DEFAULT_NSIDE)
+    args = parser.parse_args()
+
+    if args.nside & (args.nside - 1):
+        parser.error("--nside must be a power of 2")
+
+    ra, dec, matched_transits = read_catalog_columns(args.catalog)
+    table = build_table(ra, dec, matched_transits, nside=args.nside)
+    save_table(table, args.output)
+    print(f"Observation count table for {len(ra)} stars (nside={args.nside}) saved to {args.output}")
@@ -1,8 +1,12 @@
-import matplotlib.pyplot as plt
 import matplotlib.colors as colors
+import matplotlib.image as mpimg
 import matplotlib.ticker as ticker
+import io
 import numpy as np
 import os
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
 
 import utilities
@@ -11,14 +15,58 @@ import utilities
 #    This file creates the astromtric and sensitivity plots based on the queried exoplanet data    #
 ####################################################################################################
 
+# Output formats that are drawn once into a pixel buffer and encoded from it; anything else
+#   (pdf, svg) is written by matplotlib's vector backends
+RASTER_FORMATS = ("png", "jpg", "jpeg", "tif", "tiff", "webp")
+# Pillow only knows the full names of these formats
+RASTER_ENCODER_NAMES = {"jpg": "jpeg", "tif": "tiff"}
+
+# Output formats accepted from the user (--formats); other matplotlib backends (pgf, ps, raw, ...)
+#   need external tools or write data that is not a plot image
+SUPPORTED_FORMATS = ("pdf", "svg") + RASTER_FORMATS
+
+# Default output settings; full quality PDF and PNG
+DEFAULT_OUTPUT_FORMATS = ("pdf", "png")
+DEFAULT_DPI = 600
+
+# Thumbnail mode for bulk triage: a single low resolution PNG per plot
+THUMBNAIL_FORMATS = ("png",)
+THUMBNAIL_DPI = 50
+
+# Default layout of a contact sheet (columns x rows of plots per image)
+CONTACT_SHEET_COLUMNS = 4
+CONTACT_SHEET_ROWS = 4
+
 # Plots the astrometric signature grid for the queried stars in the given mass/sem_maj_axis grid
 def plot_astrometric_sig():
     pass
 
 # Receives matrix of SNR values and makes sensitivity plot based on the values in that grid/matrix
+#   Each requested format is encoded from the same figure; see save_figure
 def plot_snr_1_grid(semi_major_axis_1D_array, planet_masses_1D_array, grid, title_suffix,
-                    star_name, g_magnitude, distance_pc, stellar_mass_solar, known_planets=None):
-    fig, ax = plt.subplots(figsize=(10, 6))
+                    star_name, g_magnitude, distance_pc, stellar_mass_solar, known_planets=None,
+                    output_formats=DEFAULT_OUTPUT_FORMATS, dpi=DEFAULT_DPI, rasterize_contours=False,
+                    n_obs=None, plot_dir='plots'):
+    fig = build_snr_1_figure(semi_major_axis_1D_array, planet_masses_1D_array, grid, title_suffix,
+                             star_name, g_magnitude, distance_pc, stellar_mass_solar,
+                             known_planets=known_planets, rasterize_contours=rasterize_contours,
+                             n_obs=n_obs)
+
+    # Check if the filepath exists, if not create it
+    os.makedirs(f'{plot_dir}/{star_name}', exist_ok=True)
+
+    # Return the written files so the caller can record them in the run manifest
+    return save_figure(fig, f'{plot_dir}/{star_name}/{title_suffix}_snr1_grid', output_formats, dpi)
+
+# Builds the sensitivity plot figure without writing it anywhere
+#   rasterize_contours embeds the filled contours as an image in vector outputs, which keeps
+#   PDFs small and fast to write; axes, labels and the SNR_1 = 1 line stay vector
+#   n_obs is shown in the title when the grid accounts for the number of observations
+def build_snr_1_figure(semi_major_axis_1D_array, planet_masses_1D_array, grid, title_suffix,
+                       star_name, g_magnitude, distance_pc, stellar_mass_solar, known_planets=None,
+                       rasterize_contours=False, n_obs=None):
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
     vmin_snr = grid[grid > 0].min()
     vmax_snr = grid.max()
 
@@ -50,7 +98,8 @@ def plot_snr_1_grid(semi_major_axis_1D_array, planet_masses_1D_array, grid, titl
         norm=colors.LogNorm(
             vmin=vmin_snr,
             vmax=vmax_snr
-        )
+        ),
+        rasterized=rasterize_contours
     )
 
     cbar = fig.colorbar(contourplt_snr, ax=ax)
@@ -62,7 +111,7 @@ def plot_snr_1_grid(semi_major_axis_1D_array, planet_masses_1D_array, grid, titl
     cbar.update_ticks()
 
     # add a straight line where SNR1 = 1
-    plt.contour(
+    ax.contour(
         semi_major_axis_1D_array,
         planet_masses_1D_array,
         grid,
@@ -93,6 +142,7 @@ def plot_snr_1_grid(semi_major_axis_1D_array, planet_masses_1D_array, grid, titl
     if known_planets:
         # print("ADDING A PLANET")
         planets_outside_bounds = []
+        planet_label = 'Known Planet'
         for (a_au, m_jup) in known_planets:
             if a_au < semi_major_axis_1D_array.min() or a_au > semi_major_axis_1D_array.max():
                 planets_outside_bounds.append((a_au, m_jup))
@@ -100,36 +150,127 @@ def plot_snr_1_grid(semi_major_axis_1D_array, planet_masses_1D_array, grid, titl
             if m_jup < planet_masses_1D_array.min() or m_jup > planet_masses_1D_array.max():
                 planets_outside_bounds.append((a_au, m_jup))
                 continue
-            plt.plot(
+            ax.plot(
                 a_au,
                 m_jup,
                 marker='o',
                 color='white',
                 markersize=8,
                 markeredgecolor='black',
-                label='Known Planet'
+                label=planet_label
             )
-        plt.legend(loc='upper right')
+            # Only label the first marker so the legend has a single entry
+            planet_label = None
+        if planet_label is None:
+            ax.legend(loc='upper right')
         if len(planets_outside_bounds) > 0:
             print("Known planets outside plot bounds (not shown):", planets_outside_bounds)
 
     fig.suptitle(
         f'{title_suffix} $SNR_1$ Grid: {star_name} | '
         f'G_mag={g_magnitude} | Dist={distance_pc} pc | '
-        rf'$M_\star$={stellar_mass_solar} $M_\odot$',
+        rf'$M_\star$={stellar_mass_solar} $M_\odot$'
+        + (f' | $N_{{obs}}$={n_obs}' if n_obs is not None else ''),
         fontsize=12,
         x=0.5,
         ha='center'
     )
 
-    # Check if the filepath exists, if not create it
-    if not os.path.exists('plots'):
-        os.makedirs('plots')
-    if not os.path.exists(f'plots/{star_name}'):
-        os.makedirs(f'plots/{star_name}')
+    return fig
+
+# Writes the figure to <output_base>.<format> for each requested format and returns the paths
+#   Raster formats are rendered once into an RGBA buffer and each is encoded from that buffer
+#   rather than re-drawing the figure per format
+def save_figure(fig, output_base, output_formats=DEFAULT_OUTPUT_FORMATS, dpi=DEFAULT_DPI):
+    output_paths = []
+    rgba = None
+    for output_format in output_formats:
+        output_path = f'{output_base}.{output_format}'
+        if output_format.lower() in RASTER_FORMATS:
+            if rgba is None:
+                rgba = render_rgba(fig, dpi)
+            encode_rgba(output_path, rgba, output_format, dpi)
+        else:
+            fig.savefig(output_path, format=output_format.lower(), dpi=dpi)
+        output_paths.append(output_path)
+    return output_paths
+
+# Encodes the figure in a single format and returns the file contents, without touching disk
+def figure_bytes(fig, output_format="png", dpi=DEFAULT_DPI):
+    buffer = io.BytesIO()
+    if output_format.lower() in RASTER_FORMATS:
+        encode_rgba(buffer, render_rgba(fig, dpi), output_format, dpi)
+    else:
+        fig.savefig(buffer, format=output_format.lower(), dpi=dpi)
+    return buffer.getvalue()
+
+# Draws the figure with the Agg renderer and returns the pixel buffer as an (H, W, 4) array
+def render_rgba(fig, dpi):
+    canvas = FigureCanvasAgg(fig)
+    fig.set_dpi(dpi)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba())
+
+# Encodes a pixel buffer from render_rgba in a raster format, into a path or file object
+def encode_rgba(target, rgba, output_format, dpi):
+    output_format = output_format.lower()
+    mpimg.imsave(target, rgba, format=RASTER_ENCODER_NAMES.get(output_format, output_format), dpi=dpi)
+
+# Opens a single PDF that batch plots are streamed into, one page per figure
+#   Use as a context manager; pages are written as they are added, so memory use does not grow
+#   with the number of stars
+def open_multipage_pdf(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return PdfPages(path)
+
+# Tiles many plots into a few large PNG images instead of writing files per star
+#   Each figure is drawn at a low resolution and pasted into the current sheet; a sheet is written
+#   to <path_prefix>_0001.png, <path_prefix>_0002.png, ... as soon as it is full
+class ContactSheet:
+    def __init__(self, path_prefix, columns=CONTACT_SHEET_COLUMNS, rows=CONTACT_SHEET_ROWS,
+                 dpi=THUMBNAIL_DPI):
+        self.path_prefix = path_prefix
+        self.columns = columns
+        self.rows = rows
+        self.dpi = dpi
+        self.sheet = None
+        self.tile_count = 0
+        self.output_paths = []
+
+    def add(self, fig):
+        tile = render_rgba(fig, self.dpi)
+        tile_height, tile_width = tile.shape[:2]
+        if self.sheet is None:
+            # White background so partially filled sheets have empty (not transparent) tiles
+            self.sheet = np.full((tile_height * self.rows, tile_width * self.columns, 4), 255,
+                                 dtype=np.uint8)
+        row, column = divmod(self.tile_count, self.columns)
+        self.sheet[row * tile_height:(row + 1) * tile_height,
+                   column * tile_width:(column + 1) * tile_width] = tile
+        self.tile_count += 1
+        if self.tile_count == self.columns * self.rows:
+            self._write_sheet()
+
+    # Writes any partially filled sheet and returns the paths of all written sheets
+    def close(self):
+        if self.tile_count > 0:
+            self._write_sheet()
+        return self.output_paths
+
+    def _write_sheet(self):
+        directory = os.path.dirname(self.path_prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        output_path = f'{self.path_prefix}_{len(self.output_paths) + 1:04d}.png'
+        mpimg.imsave(output_path, self.sheet, format='png', dpi=self.dpi)
+        self.output_paths.append(output_path)
+        self.sheet = None
+        self.tile_count = 0
 
-    plt.savefig(f'plots/{star_name}/{title_suffix}_snr1_grid.pdf', dpi=600)
-    plt.savefig(f'plots/{star_name}/{title_suffix}_snr1_grid.png', dpi=600)
-    # plt.show()
+    def __enter__(self):
+        return self
 
-    plt.close()
\ No newline at end of file
+    def __exit__(self, *exc_info):
+        self.close()
@@ -2,91 +2,182 @@
 #   the desired planet based on user input and retrieve relevant data.
 
 import numpy as np
+import os
 import pandas as pd
 import pyvo as vo
 import re
 import requests
+import threading
 from astroquery.gaia import Gaia
 from astroquery.simbad import Simbad
 
+import checkpoint
+import local_catalog
+import utilities
+
 # Initialize TAP service for NASA Exoplanet Archive
 service = vo.dal.TAPService("https://exoplanetarchive.ipac.caltech.edu/TAP")
 
+# Local cache of known planets, keyed by Gaia DR3 source_id, shared between runs
+KNOWN_PLANETS_CACHE_FILENAME = "known_planets_cache.pkl"
+# Number of Gaia DR3 IDs per Exoplanet Archive request; keeps the query text a reasonable size
+KNOWN_PLANETS_CHUNK_SIZE = 500
+
+# Known planets caches loaded by this process, keyed by cache file name. The file is read once
+#   per process, and the lock serializes lookups and cache updates, so concurrent callers (i.e.
+#   the request threads of service.py) never rewrite the file at the same time
+_known_planets_caches = {}
+_known_planets_lock = threading.Lock()
+
+# Columns fetched for each star from gaiadr3.gaia_source and gaiadr3.astrophysical_parameters
+#   A local catalog extract (see local_catalog.py) must provide the same columns
+GAIA_SOURCE_COLUMNS = [
+    "source_id", "ra", "ra_error", "dec", "dec_error", "parallax", "parallax_error", "pm", "pmra",
+    "pmra_error", "pmdec", "pmdec_error", "distance_gspphot", "distance_gspphot_lower",
+    "distance_gspphot_upper", "astrometric_n_obs_al", "astrometric_n_obs_ac",
+    "astrometric_n_good_obs_al", "astrometric_n_bad_obs_al", "matched_transits", "phot_g_mean_mag",
+    "phot_bp_mean_mag", "phot_rp_mean_mag", "teff_gspphot", "teff_gspphot_lower",
+    "teff_gspphot_upper", "logg_gspphot", "logg_gspphot_lower", "logg_gspphot_upper", "mh_gspphot",
+    "mh_gspphot_lower", "mh_gspphot_upper", "astrometric_matched_transits", "ag_gspphot",
+    "ag_gspphot_lower", "ag_gspphot_upper"
+]
+ASTROPHYSICAL_PARAMETERS_COLUMNS = [
+    "mass_flame", "mass_flame_lower", "mass_flame_upper", "radius_flame", "radius_flame_lower",
+    "radius_flame_upper"
+]
+GAIA_QUERY_COLUMNS = GAIA_SOURCE_COLUMNS + ASTROPHYSICAL_PARAMETERS_COLUMNS
+
+# Gaia DR3 IDs can be read straight from the input instead of being resolved through SIMBAD
+GAIA_DR3_ID_PATTERN = re.compile(r"^\s*Gaia\s+DR3\s+(\d+)\s*$", re.IGNORECASE)
+
 # Converts python list into SQL readable (essentially drops the [] square brackets)
 def sql_string_list(values):
     return ",".join(f"'{v}'" for v in values)
 
-def exoplanet_query(planet_ids, data_release):
-    if data_release == 'DR5':
-        # This sets a limit of 9.5 years on orbital periods for DR5 observations
-        # Unit in days
-        orb_period = 3469.875
-    else:
-        # This is the limit for DR4 observations of 4.0 years
-        # Unit in days
-        orb_period = 1461  # Example value for DR4
-
-    print(orb_period, type(orb_period))
-
-    # Query Simbad to get Gaia DR3 IDs for the provided planet IDs (if they are not already Gaia DR3 IDs)
-    #   This is necessary as we are going to query the Gaia archive, which relies on Gaia IDs
-
-
-    # Group the planet IDs into lists
-    gaia_ids = planet_ids.loc[planet_ids['cat_id_type'] == 'gaia_dr3_id', 'ID'].tolist()
-    tic_ids = planet_ids.loc[planet_ids['cat_id_type'] == 'tic_id', 'ID'].tolist()
-    hip_names = planet_ids.loc[planet_ids['cat_id_type'] == 'hip_name', 'ID'].tolist()
-    hd_names = planet_ids.loc[planet_ids['cat_id_type'] == 'hd_name', 'ID'].tolist()
-
-    # Build SQL WHERE clauses
-    clauses = []
-
-    if gaia_ids:
-        gaia_ids_sql = sql_string_list(gaia_ids)
-        clauses.append(f"gaia_dr3_id IN ({gaia_ids_sql})")
-        print("Gaia IDs for query:", gaia_ids)
-    if tic_ids:
-        tic_ids_sql = sql_string_list(tic_ids)
-        clauses.append(f"tic_id IN ({tic_ids_sql})")
-    if hip_names:
-        hip_names_sql = sql_string_list(hip_names)
-        clauses.append(f"hip_name IN ({hip_names_sql})")
-    if hd_names:
-        hd_names_sql = sql_string_list(hd_names)
-        clauses.append(f"hd_name IN ({hd_names_sql})")
-    if not clauses:
-        raise ValueError("No valid IDs to query")
-
-    id_where = " OR ".join(clauses)
-
-    """Query the NASA Exoplanet Archive for exoplanet data based on planet ID and type."""
-    
-    query = f'''SELECT pl_name, hostname, pl_letter, gaia_dr3_id, sy_snum,
-                               sy_pnum, discoverymethod, pl_orbper, pl_orbperlim, pl_orbsmax,
-                               pl_radj, pl_bmassj, pl_bmassprov, pl_orbeccen, st_teff, st_rad,
-                               st_mass, st_met, st_metratio, rastr, ra, decstr, dec, sy_dist,
-                               sy_plx, sy_gaiamag FROM ps
-                               WHERE default_flag=1
-                                    AND pl_orbper <= {orb_period}
-                                    AND ({id_where})
-                               ORDER BY pl_name'''
-    print("Executing query:\n", query)
-    
-    resultset = service.search(f'''SELECT pl_name, hostname, pl_letter, gaia_dr3_id, sy_snum,
-                               sy_pnum, discoverymethod, pl_orbper, pl_orbperlim, pl_orbsmax,
-                               pl_radj, pl_bmassj, pl_bmassprov, pl_orbeccen, st_teff, st_rad,
-                               st_raderr1, st_mass, st_met, st_metratio, rastr, ra, decstr, dec,
-                               sy_dist, sy_plx, sy_gaiamag FROM ps
-                               WHERE default_flag=1
-                                    AND pl_orbper <= {orb_period}
-                                    AND ({id_where})
-                               ORDER BY pl_name''')
-
-    result_df = resultset.to_table().to_pandas()
+def known_planets_query(source_ids, cache_filename=KNOWN_PLANETS_CACHE_FILENAME, refresh=False):
+    """
+    Batch query the NASA Exoplanet Archive for the known planets around the given Gaia DR3
+    source_ids and return a mapping of {source_id: [(semi_major_axis_au, mass_mjup), ...]}
 
-    # Check for missing planet ids / rows? where the query failed?
+    Results (including hosts without any known planets) are cached locally, so only source_ids
+    that have never been looked up are sent to the archive. With refresh, the given source_ids are
+    looked up again and their cached entries replaced; entries of other stars are kept.
+    """
 
-    return result_df
+    source_ids = [int(source_id) for source_id in source_ids]
+    with _known_planets_lock:
+        return _known_planets_lookup(source_ids, cache_filename, refresh)
+
+def _known_planets_lookup(source_ids, cache_filename, refresh):
+    # The cache of previous lookups, read from the file on first use
+    cache = _known_planets_caches.get(cache_filename)
+    if cache is None:
+        cache = _read_known_planets_cache(cache_filename)
+        _known_planets_caches[cache_filename] = cache
+
+    uncached_ids = sorted(set(source_ids) if refresh else set(source_ids) - cache["queried_ids"])
+    if uncached_ids:
+        print(f"Querying the Exoplanet Archive for known planets around {len(uncached_ids)} stars...")
+        new_planets = []
+        fetched_ids = []
+        try:
+            for start in range(0, len(uncached_ids), KNOWN_PLANETS_CHUNK_SIZE):
+                chunk = uncached_ids[start:start + KNOWN_PLANETS_CHUNK_SIZE]
+                chunk_sql = sql_string_list([f"Gaia DR3 {source_id}" for source_id in chunk])
+                resultset = service.search(f'''SELECT pl_name, gaia_dr3_id, pl_orbper, pl_orbsmax,
+                                                 pl_bmassj, st_mass FROM ps
+                                          WHERE default_flag=1
+                                               AND gaia_dr3_id IN ({chunk_sql})''')
+                new_planets.append(resultset.to_table().to_pandas())
+                fetched_ids.extend(chunk)
+        except (vo.dal.DALAccessError, requests.exceptions.RequestException) as e:
+            print(f"\nWARNING: Exoplanet Archive query failed ({e}).")
+            print("Known planets will only be shown for stars already in the local cache.")
+
+        # Replace the cached planets of the stars that were fetched (only refreshed stars have
+        #   any); nothing changes, and nothing is saved, if the archive could not be reached
+        if fetched_ids:
+            kept_planets = cache["planets"][~cache["planets"]["source_id"].isin(fetched_ids)]
+            cache["planets"] = pd.concat([kept_planets, *[_known_planet_positions(df) for df in new_planets]],
+                                         ignore_index=True)
+            cache["queried_ids"].update(fetched_ids)
+            _save_known_planets_cache(cache, cache_filename)
+
+    # Route the planets to their host stars
+    known_planets = {source_id: [] for source_id in source_ids}
+    wanted = cache["planets"][cache["planets"]["source_id"].isin(list(known_planets))]
+    for planet in wanted.itertuples(index=False):
+        known_planets[int(planet.source_id)].append((float(planet.a_au), float(planet.m_jup)))
+
+    print(f"Found known planets around {sum(1 for p in known_planets.values() if p)} of {len(source_ids)} stars.")
+    return known_planets
+
+def _empty_known_planets_cache():
+    return {"queried_ids": set(), "planets": pd.DataFrame(columns=["source_id", "pl_name", "a_au", "m_jup"])}
+
+def _read_known_planets_cache(cache_filename):
+    if os.path.isfile(cache_filename):
+        try:
+            return pd.read_pickle(cache_filename)
+        except Exception as e:
+            print(f"WARNING: Could not read known planets cache {cache_filename} ({e}); rebuilding it.")
+    return _empty_known_planets_cache()
+
+# Writes the cache atomically, first adding the stars that other processes (i.e. concurrent shards)
+#   have saved to the file since this process read it
+def _save_known_planets_cache(cache, cache_filename):
+    on_disk = _read_known_planets_cache(cache_filename)
+    other_ids = on_disk["queried_ids"] - cache["queried_ids"]
+    if other_ids:
+        cache["queried_ids"].update(other_ids)
+        other_planets = on_disk["planets"][on_disk["planets"]["source_id"].isin(list(other_ids))]
+        cache["planets"] = pd.concat([cache["planets"], other_planets], ignore_index=True)
+    with checkpoint.atomic_path(cache_filename) as tmp_path:
+        pd.to_pickle(cache, tmp_path)
+
+# Converts Exoplanet Archive rows into (semi-major axis [AU], mass [M_J]) per host source_id
+#   When the archive has no semi-major axis, it is derived from the period and stellar mass
+def _known_planet_positions(planets_df):
+    if planets_df.empty:
+        return pd.DataFrame(columns=["source_id", "pl_name", "a_au", "m_jup"])
+
+    a_au = planets_df["pl_orbsmax"].astype(float)
+    a_from_period = utilities.period_to_a(planets_df["pl_orbper"].astype(float),
+                                          planets_df["st_mass"].astype(float))
+    a_au = a_au.fillna(a_from_period)
+
+    positions = pd.DataFrame({
+        "source_id": planets_df["gaia_dr3_id"].astype(str).str.extract(r"(\d+)\s*$")[0],
+        "pl_name": planets_df["pl_name"],
+        "a_au": a_au,
+        "m_jup": planets_df["pl_bmassj"].astype(float),
+    }).dropna()
+    positions["source_id"] = positions["source_id"].astype("int64")
+    return positions
+
+# SIMBAD client and Gaia@AIP session are created once and reused, so repeated queries in one
+#   process (i.e. the HTTP service) share their connections
+_simbad_client = None
+_aip_tap_service = None
+
+def _simbad():
+    global _simbad_client
+    if _simbad_client is None:
+        _simbad_client = Simbad()
+        _simbad_client.add_votable_fields("ids")
+    return _simbad_client
+
+def _aip_service():
+    global _aip_tap_service
+    if _aip_tap_service is None:
+        # For Gaia@AIP service; a backup if the gaia database is down
+        url = "https://gaia.aip.de/tap"
+        # token = 'Token <your-token>'
+        # Setup authorization
+        tap_session = requests.Session()
+        # tap_session.headers['Authorization'] = token
+        _aip_tap_service = vo.dal.TAPService(url, session=tap_session)
+    return _aip_tap_service
 
 def querySimbad(IDs):
     """
@@ -94,10 +185,7 @@ def querySimbad(IDs):
     {input_id: matched_catalog_id}
     """
 
-    customSimbad = Simbad()
-    customSimbad.add_votable_fields("ids")
-
-    result = customSimbad.query_objects(IDs)
+    result = _simbad().query_objects(IDs)
 
     # print("Columns returned:", result.colnames) # DEBUG LINE
     # print("Result of SIMBAD query:", result) # DEBUG LINE
@@ -122,7 +210,25 @@ def querySimbad(IDs):
 
     return id_map
 
-def gaia_query(planet_ids, data_release):
+# Gaia DR3 IDs are taken as given; every other ID is resolved with a batched SIMBAD query
+def resolve_gaia_ids(IDs):
+    id_map = {}
+    simbad_ids = []
+    for id_ in IDs:
+        match = GAIA_DR3_ID_PATTERN.match(id_)
+        if match:
+            id_map[id_] = match.group(1)
+        else:
+            simbad_ids.append(id_)
+
+    if simbad_ids:
+        id_map.update(querySimbad(simbad_ids))
+
+    return {id_: id_map.get(id_) for id_ in IDs}
+
+# local_catalog_path reads the stellar parameters from a local Parquet extract instead of the
+#   Gaia archive (see local_catalog.py)
+def gaia_query(planet_ids, data_release, local_catalog_path=None):
     if data_release == 'DR5':
         # This sets a limit of 9.5 years on orbital periods for DR5 observations
         # Unit in days
@@ -138,8 +244,13 @@ def gaia_query(planet_ids, data_release):
     # Query Simbad to get Gaia DR3 IDs for the provided planet IDs (if they are not already Gaia DR3 IDs)
     #   This is necessary as we are going to query the Gaia archive, which relies on Gaia IDs
 
-    gaia_dr3_id_map = querySimbad(id_list)
+    gaia_dr3_id_map = resolve_gaia_ids(id_list)
+    found = check_resolved_ids(gaia_dr3_id_map)
 
+    return fetch_gaia_rows(list(found.values()), local_catalog_path)
+
+# Returns the {input_id: gaia_dr3_id} entries that were resolved; raises ValueError if any were not
+def check_resolved_ids(gaia_dr3_id_map):
     found = {k: v for k, v in gaia_dr3_id_map.items() if v is not None}
     missing = [k for k, v in gaia_dr3_id_map.items() if v is None]
 
@@ -153,23 +264,22 @@ def gaia_query(planet_ids, data_release):
     else:
         print("Results: ", list(found.values()))
 
-    sql_form_gaia_dr3_ids = sql_string_list(list(found.values()))
+    return found
+
+# Fetches the Gaia rows (GAIA_QUERY_COLUMNS) of the given Gaia DR3 source_ids from the Gaia archive,
+#   the Gaia@AIP backup, or a local Parquet extract if local_catalog_path is given
+def fetch_gaia_rows(gaia_dr3_ids, local_catalog_path=None):
+    if local_catalog_path is not None:
+        print(f"Reading stellar parameters from local catalog {local_catalog_path}")
+        return local_catalog.local_gaia_query(gaia_dr3_ids, local_catalog_path, GAIA_QUERY_COLUMNS)
+
+    sql_form_gaia_dr3_ids = sql_string_list(gaia_dr3_ids)
 
     print("ABOUT TO QUERY")
     try:
-        query = f'''SELECT gs.source_id, gs.ra, gs.ra_error, gs.dec, gs.dec_error,
-                            gs.parallax, gs.parallax_error, gs.pm, gs.pmra, gs.pmra_error,
-                            gs.pmdec, gs.pmdec_error, gs.distance_gspphot, gs.distance_gspphot_lower,
-                            gs.distance_gspphot_upper, gs.astrometric_n_obs_al,
-                            gs.astrometric_n_obs_ac, gs.astrometric_n_good_obs_al,
-                            gs.astrometric_n_bad_obs_al, gs.matched_transits, gs.phot_g_mean_mag,
-                            gs.phot_bp_mean_mag, gs.phot_rp_mean_mag, gs.teff_gspphot,
-                            gs.teff_gspphot_lower, gs.teff_gspphot_upper, gs.logg_gspphot,
-                            gs.logg_gspphot_lower, gs.logg_gspphot_upper, gs.mh_gspphot,
-                            gs.mh_gspphot_lower, gs.mh_gspphot_upper, gs.astrometric_matched_transits,
-                            gs.ag_gspphot, gs.ag_gspphot_lower, gs.ag_gspphot_upper,
-                            ap.mass_flame, ap.mass_flame_lower, ap.mass_flame_upper, ap.radius_flame,
-                            ap.radius_flame_lower, ap.radius_flame_upper
+        select_columns = ", ".join([f"gs.{column}" for column in GAIA_SOURCE_COLUMNS]
+                                   + [f"ap.{column}" for column in ASTROPHYSICAL_PARAMETERS_COLUMNS])
+        query = f'''SELECT {select_columns}
                     FROM gaiadr3.gaia_source AS gs
                     LEFT JOIN gaiadr3.astrophysical_parameters AS ap
                         ON gs.source_id = ap.source_id
@@ -185,13 +295,7 @@ def gaia_query(planet_ids, data_release):
 
         print("\nIn the mean time, attempting backup query to Gaia@AIP service...")
         # Try backup database query if Gaia database is down
-        # For Gaia@AIP service; a backup if the gaia database is down
-        url = "https://gaia.aip.de/tap"
-        # token = 'Token <your-token>'
-        # Setup authorization
-        tap_session = requests.Session()
-        # tap_session.headers['Authorization'] = token
-        tap_service = vo.dal.TAPService(url, session=tap_session)
+        tap_service = _aip_service()
         lang = "PostgreSQL"
         TAP_results = tap_service.run_sync(query, language=lang)
         results = TAP_results.to_table()
@@ -206,4 +310,70 @@ def gaia_query(planet_ids, data_release):
 
     # Check for missing planet ids / rows? where the query failed?
 
-    return results_df
\ No newline at end of file
+    return results_df
+
+# Quality checks on the Gaia query results: fills in missing distances (from parallax) and stellar
+#   masses where possible, then drops the stars that still lack either
+def clean_query_results(returned_query):
+    # If distance is missing, check if parallax is viable (S/N > 10) and use that to estimate distance
+    returned_query["distance_estimated_flag"] = 0
+    snr_parallax = returned_query['parallax'] / returned_query['parallax_error']
+
+
+    distance_mask = (
+        returned_query["distance_gspphot"].isna() &
+        returned_query["parallax"].notna() &
+        returned_query["parallax_error"].notna() &
+        (returned_query["parallax"] > 0) &
+        (snr_parallax >= 10)
+    )
+
+    returned_query.loc[distance_mask, "distance_gspphot"] = (
+        (1000.0 / returned_query.loc[distance_mask, "parallax"])
+        .astype("float32")
+    )
+    returned_query.loc[distance_mask, "distance_estimated_flag"] = 1
+    print(f"Estimated distances for {distance_mask.sum()} stars (parallax S/N >= 10).")
+    
+    # If stellar mass is missing, use color and abs mag to estimate stellar type and then mass (this is a very rough estimate and can be improved in the future by using isochrones or something similar)
+    #    - this is a very rough estimate and can be improved in the future
+    returned_query["st_mass_estimated_flag"] = 0
+    st_mass_mask = (
+        returned_query["mass_flame"].isna() &
+        returned_query["phot_g_mean_mag"].notna() &
+        returned_query["phot_bp_mean_mag"].notna() &
+        returned_query["phot_rp_mean_mag"].notna() &
+        returned_query["distance_gspphot"].notna()
+    )
+    returned_query.loc[st_mass_mask, "mass_flame"] = utilities.estimate_stellar_mass(
+        returned_query.loc[st_mass_mask, "phot_g_mean_mag"],
+        returned_query.loc[st_mass_mask, "phot_bp_mean_mag"],
+        returned_query.loc[st_mass_mask, "phot_rp_mean_mag"],
+        returned_query.loc[st_mass_mask, "distance_gspphot"]
+    )
+    returned_query.loc[st_mass_mask, "st_mass_estimated_flag"] = 1
+    print(f"Estimated stellar masses for {st_mass_mask.sum()} stars based on color and absolute magnitude.")
+
+    # Find any rows with NaNs
+    # Find rows with NaNs in mass_flame or distance_gspphot (the two most important parameters for the astrometric signature calculation) and print out which columns are missing for each row; then drop those rows for the rest of the analysis for now (but save them in a separate dataframe and print them out so we can see how many and which rows are being dropped and what info is missing for those rows)
+    nan_rows = returned_query[returned_query[['mass_flame', 'distance_gspphot']].isna().any(axis=1)]
+    missing_info = nan_rows.apply(lambda row: [col for col in ['mass_flame', 'distance_gspphot'] if pd.isna(row[col])], axis=1)
+    nan_rows = nan_rows.assign(missing_info=missing_info)
+    # For now, just drop the rows that contain an NaN
+    clean_df = returned_query.dropna(subset=['mass_flame', 'distance_gspphot'])
+
+    # Print the nan_rows dataframe without the columns information after the analysis to avoid cluttering the output
+    if not nan_rows.empty:
+        print(f"\n{len(nan_rows)} rows contain NaN values in mass_flame or distance_gspphot and will be dropped from the analysis:")
+        print(nan_rows.drop(columns=['missing_info']))
+        print("\nThe following columns are missing for each of these rows:")
+        for index, row in nan_rows.iterrows():
+            print(f"Row {index}: Missing {row['missing_info']}")
+    else:
+        print("\nNo rows contain NaN values in mass_flame or distance_gspphot.")
+
+    # Possible way to estimate distance if missing, before checking for NaN rows
+    #    - may want to only do this for rows with a certain S/N for the parallax measurement (>10?)
+    # returned_query.fillna({'distance_gspphot': 1000.0 / df['parallax']})
+
+    return clean_df
@@ -0,0 +1,270 @@
+# This file runs the tool as a long-running local HTTP service, so callers (i.e. a web front end)
+#   do not pay for a fresh process, imports, grid set-up and archive connections on every star.
+#
+# The process keeps warm between requests:
+#   - the period/mass grid
+#   - resolved IDs (input ID -> Gaia DR3 source_id) and cleaned stellar parameters per star
+#   - known planets per star (backed by the same local cache as main.py)
+#   - the observation count table, if given (--nobs_table)
+#   - the SIMBAD / Gaia archive clients and their connections (see query.py)
+#
+# Endpoints (GET, parameters in the query string):
+#   /health                                        -> {"status": "ok"}
+#   /star?id=<ID>                                  -> stellar parameters as JSON
+#   /grid?id=<ID>[&format=json|npz]                -> semi-major axes, planet masses and both SNR1
+#                                                     grids, as JSON or as a binary .npz archive
+#   /plot?id=<ID>[&model=theoretical|actual][&format=png|pdf|svg|jpg][&dpi=10..600][&known_planets=0]
+#                                                  -> the rendered sensitivity plot
+#
+# Example: python service.py --port 8765
+#          curl 'http://127.0.0.1:8765/grid?id=TIC%20408618999'
+
+import argparse
+import io
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+# Local modules
+import obs_counts
+import plotting
+import query
+import utilities
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_PLOT_DPI = 100
+# Accepted plot resolutions; the pixel buffer grows with dpi squared and is rendered under the
+#   render lock, so one huge request would stall every other one
+MIN_PLOT_DPI = 10
+MAX_PLOT_DPI = 600
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "pdf": "application/pdf",
+    "svg": "image/svg+xml",
+}
+
+DEVIATION_ANGLE_MODELS = {
+    "theoretical": "Theoretical Deviation Angle",
+    "actual": "Actual Deviation Angle",
+}
+
+# Raised for requests that cannot be answered; carries the HTTP status to return
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# Pipeline state shared by all request threads
+class WarmPipeline:
+    def __init__(self, data_release="DR4", local_catalog_path=None, known_planets=True,
+                 nobs_table_path=None):
+        self.data_release = data_release
+        self.local_catalog_path = local_catalog_path
+        self.known_planets = known_planets
+        self.nobs_table = obs_counts.load_table(nobs_table_path) if nobs_table_path else None
+
+        self.period_days, self.planet_masses = utilities.period_mass_grid()
+        self.converted_period_years = (self.period_days / 365.25)**(2/3)
+
+        self.source_ids = {}
+        self.stars = {}
+        self.planets = {}
+        self.lock = threading.Lock()
+        # Matplotlib is not safe to render from several threads at once
+        self.render_lock = threading.Lock()
+
+    # Returns the cleaned Gaia row of a star, querying and caching it on first use
+    def star(self, planet_id):
+        with self.lock:
+            source_id = self.source_ids.get(planet_id)
+            if source_id is not None:
+                return self.stars[source_id]
+
+        try:
+            returned_query = query.gaia_query(pd.DataFrame({"ID": [planet_id]}), self.data_release,
+                                              local_catalog_path=self.local_catalog_path)
+        except ValueError as e:
+            raise RequestError(404, f"Could not resolve {planet_id}: {e}")
+        if returned_query.empty:
+            raise RequestError(404, f"{planet_id} was not found in the Gaia catalog")
+        clean_df = query.clean_query_results(returned_query)
+        if clean_df.empty:
+            raise RequestError(422, f"{planet_id} has no usable stellar mass and distance in Gaia")
+
+        star = next(clean_df.itertuples(index=False))
+        with self.lock:
+            self.source_ids[planet_id] = int(star.source_id)
+            self.stars[int(star.source_id)] = star
+        return star
+
+    def known_planets_for(self, star):
+        source_id = int(star.source_id)
+        with self.lock:
+            if source_id in self.planets:
+                return self.planets[source_id]
+        planets = query.known_planets_query([source_id]).get(source_id) or None
+        with self.lock:
+            self.planets[source_id] = planets
+        return planets
+
+    # Expected number of observations of the star, or None without an observation count table
+    def n_obs(self, star):
+        if self.nobs_table is None:
+            return None
+        return int(obs_counts.expected_observations(self.nobs_table, star.ra, star.dec, self.data_release))
+
+    def grids(self, star):
+        return utilities.star_snr_grids(star.mass_flame, star.distance_gspphot, star.phot_g_mean_mag,
+                                        self.converted_period_years, self.planet_masses, self.n_obs(star))
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # Set by serve()
+    pipeline = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        routes = {
+            "/health": self.handle_health,
+            "/star": self.handle_star,
+            "/grid": self.handle_grid,
+            "/plot": self.handle_plot,
+        }
+        handler = routes.get(url.path.rstrip("/") or "/")
+        try:
+            if handler is None:
+                raise RequestError(404, f"Unknown endpoint {url.path}")
+            handler(params)
+        except RequestError as e:
+            self.send_json({"error": str(e)}, status=e.status)
+        except Exception as e:
+            self.send_json({"error": f"{type(e).__name__}: {e}"}, status=500)
+
+    def handle_health(self, params):
+        self.send_json({"status": "ok"})
+
+    def handle_star(self, params):
+        star = self.pipeline.star(require(params, "id"))
+        self.send_json({column: json_value(value) for column, value in star._asdict().items()})
+
+    def handle_grid(self, params):
+        star = self.pipeline.star(require(params, "id"))
+        semi_major_axis, snr_theoretical, snr_actual = self.pipeline.grids(star)
+        output_format = params.get("format", "json").lower()
+
+        if output_format == "npz":
+            buffer = io.BytesIO()
+            np.savez(buffer, source_id=np.int64(star.source_id), semi_major_axis_au=semi_major_axis,
+                     planet_mass_mjup=self.pipeline.planet_masses,
+                     snr_theoretical=snr_theoretical, snr_actual=snr_actual)
+            self.send_bytes(buffer.getvalue(), "application/octet-stream")
+        elif output_format == "json":
+            self.send_json({
+                "source_id": int(star.source_id),
+                "n_obs": self.pipeline.n_obs(star),
+                "semi_major_axis_au": json_array(semi_major_axis),
+                "planet_mass_mjup": json_array(self.pipeline.planet_masses),
+                "snr_theoretical": json_array(snr_theoretical),
+                "snr_actual": json_array(snr_actual),
+            })
+        else:
+            raise RequestError(400, f"Unsupported grid format {output_format}; use json or npz")
+
+    def handle_plot(self, params):
+        model = params.get("model", "actual").lower()
+        output_format = params.get("format", "png").lower()
+        if model not in DEVIATION_ANGLE_MODELS:
+            raise RequestError(400, f"Unknown model {model}; use theoretical or actual")
+        if output_format not in CONTENT_TYPES:
+            raise RequestError(400, f"Unsupported plot format {output_format}")
+        try:
+            dpi = int(params.get("dpi", DEFAULT_PLOT_DPI))
+        except ValueError:
+            raise RequestError(400, "dpi must be an integer")
+        if not MIN_PLOT_DPI <= dpi <= MAX_PLOT_DPI:
+            raise RequestError(400, f"dpi must be between {MIN_PLOT_DPI} and {MAX_PLOT_DPI}")
+
+        star = self.pipeline.star(require(params, "id"))
+        semi_major_axis, snr_theoretical, snr_actual = self.pipeline.grids(star)
+        known_planets = None
+        if self.pipeline.known_planets and params.get("known_planets", "1") != "0":
+            known_planets = self.pipeline.known_planets_for(star)
+
+        with self.pipeline.render_lock:
+            fig = plotting.build_snr_1_figure(semi_major_axis,
+                                              self.pipeline.planet_masses,
+                                              snr_theoretical if model == "theoretical" else snr_actual,
+                                              title_suffix=DEVIATION_ANGLE_MODELS[model],
+                                              star_name=star.source_id,
+                                              g_magnitude=star.phot_g_mean_mag,
+                                              distance_pc=star.distance_gspphot,
+                                              stellar_mass_solar=star.mass_flame,
+                                              known_planets=known_planets,
+                                              n_obs=self.pipeline.n_obs(star))
+            image = plotting.figure_bytes(fig, output_format, dpi)
+        self.send_bytes(image, CONTENT_TYPES[output_format])
+
+    def send_json(self, payload, status=200):
+        self.send_bytes(json.dumps(payload).encode(), "application/json", status)
+
+    def send_bytes(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def require(params, name):
+    if not params.get(name):
+        raise RequestError(400, f"Missing required parameter '{name}'")
+    return params[name]
+
+# Converts numpy/pandas scalars to JSON values (NaN becomes null)
+def json_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+# Converts a numpy array to nested JSON lists; NaN and infinite values (i.e. the grids of a star
+#   without a G magnitude) become null, since JSON has no literal for them
+def json_array(array):
+    array = np.asarray(array, dtype=float)
+    return np.where(np.isfinite(array), array, None).tolist()
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, **pipeline_options):
+    ServiceHandler.pipeline = WarmPipeline(**pipeline_options)
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    print(f"Serving on http://{host}:{port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--dr5', '--DR5', '--Dr5', action='store_true')
+    parser.add_argument('--local_catalog', '--LOCAL_CATALOG', '--Local_Catalog')
+    parser.add_argument('--no_known_planets', '--NO_KNOWN_PLANETS', '--No_Known_Planets', action='store_true')
+    parser.add_argument('--nobs_table', '--NOBS_TABLE', '--Nobs_Table')
+    args = parser.parse_args()
+
+    serve(args.host, args.port,
+          data_release='DR5' if args.dr5 else 'DR4',
+          local_catalog_path=args.local_catalog,
+          known_planets=not args.no_known_planets,
+          nobs_table_path=args.nobs_table)
@@ -0,0 +1,256 @@
+# This file spreads one target list over many processes or nodes without a coordination service:
+#   - Sharding: main.py --shard i/N processes only the IDs whose hash falls in shard i (0 <= i < N),
+#     writing every output into its own run directory (shard_<i>_of_<N> unless --run_dir is given)
+#   - Work queue: a directory of job files, one per shard, that workers claim by renaming them
+#     (atomic, so each shard is claimed by exactly one worker); it only needs a shared filesystem
+#   - Merge: combines the query results, grid checkpoints, summary tables, capability indexes and
+#     manifests of the shard run directories into one result
+#
+# Queue layout: <queue>/pending, <queue>/claimed, <queue>/done and <queue>/failed hold the job
+#   files (shard_0000_of_0016.json, ...). A shard whose worker died stays in claimed/ and can be
+#   returned to pending/ with requeue; workers always run main.py with --resume, so a requeued
+#   shard continues from its checkpoints.
+#
+# Enqueue:  python shards.py enqueue queue/ --shards 16 --output_root /shared/runs -- big_list.csv --no_plot
+# Work:     python shards.py worker queue/          (on each node, as many times as wanted)
+# Requeue:  python shards.py requeue queue/ [--failed]
+# Merge:    python shards.py merge /shared/runs/shard_*_of_16 -o /shared/runs/merged
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import capability_index
+import checkpoint
+import manifest
+import summary
+
+SHARD_PATTERN = re.compile(r"^\s*(\d+)\s*/\s*(\d+)\s*$")
+QUEUE_STATES = ("pending", "claimed", "done", "failed")
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+# Parses an i/N shard specification into (i, N)
+def parse_shard(spec):
+    match = SHARD_PATTERN.match(spec)
+    if not match:
+        raise ValueError(f"Invalid shard {spec}; expected i/N, i.e. 0/4")
+    shard_index, n_shards = int(match.group(1)), int(match.group(2))
+    if n_shards < 1 or not 0 <= shard_index < n_shards:
+        raise ValueError(f"Invalid shard {spec}; the shard index must be between 0 and N-1")
+    return shard_index, n_shards
+
+def shard_run_dir(shard_index, n_shards):
+    return f"shard_{shard_index}_of_{n_shards}"
+
+# Shard of an identifier: its SHA-256 hash modulo the number of shards, so the partition is the
+#   same on every machine and for every Python process (unlike the built-in hash)
+def shard_of(identifier, n_shards):
+    normalized = " ".join(str(identifier).split())
+    digest = hashlib.sha256(normalized.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % n_shards
+
+# Boolean mask of the identifiers that belong to the given shard
+def in_shard(identifiers, shard_index, n_shards):
+    return [shard_of(identifier, n_shards) == shard_index for identifier in identifiers]
+
+####################
+# Work queue
+####################
+
+def _queue_path(queue_dir, state, name=""):
+    return os.path.join(queue_dir, state, name)
+
+def enqueue(queue_dir, n_shards, main_args, output_root="."):
+    for state in QUEUE_STATES:
+        os.makedirs(_queue_path(queue_dir, state), exist_ok=True)
+    for shard_index in range(n_shards):
+        job = {"shard": f"{shard_index}/{n_shards}", "main_args": list(main_args),
+               "run_dir": os.path.join(output_root, shard_run_dir(shard_index, n_shards))}
+        job_name = f"shard_{shard_index:04d}_of_{n_shards:04d}.json"
+        checkpoint.atomic_write_json(job, _queue_path(queue_dir, "pending", job_name))
+
+# Claims the next pending job by moving it to claimed/; returns its file name, or None if no
+#   job is left. A rename succeeds for exactly one of several workers racing for the same job
+def claim(queue_dir, worker_id):
+    for job_name in sorted(os.listdir(_queue_path(queue_dir, "pending"))):
+        try:
+            os.rename(_queue_path(queue_dir, "pending", job_name), _queue_path(queue_dir, "claimed", job_name))
+        except FileNotFoundError:
+            continue
+        with open(_queue_path(queue_dir, "claimed", job_name)) as f:
+            job = json.load(f)
+        job.update({"worker": worker_id, "claimed_at": time.time()})
+        checkpoint.atomic_write_json(job, _queue_path(queue_dir, "claimed", job_name))
+        return job_name
+    return None
+
+# Runs main.py for claimed jobs until the queue is empty; returns the number of failed jobs
+def run_worker(queue_dir, worker_id=None):
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    failed_count = 0
+    while True:
+        job_name = claim(queue_dir, worker_id)
+        if job_name is None:
+            return failed_count
+        with open(_queue_path(queue_dir, "claimed", job_name)) as f:
+            job = json.load(f)
+
+        print(f"[{worker_id}] Running shard {job['shard']} into {job['run_dir']}")
+        command = [sys.executable, MAIN_SCRIPT, *job["main_args"],
+                   "--shard", job["shard"], "--run_dir", job["run_dir"], "--resume"]
+        returncode = subprocess.run(command).returncode
+
+        job.update({"returncode": returncode, "finished_at": time.time()})
+        state = "done" if returncode == 0 else "failed"
+        failed_count += returncode != 0
+        checkpoint.atomic_write_json(job, _queue_path(queue_dir, state, job_name))
+        os.remove(_queue_path(queue_dir, "claimed", job_name))
+        print(f"[{worker_id}] Shard {job['shard']} {state}")
+
+# Returns claimed jobs (i.e. of dead workers), and failed jobs if include_failed, to pending/
+def requeue(queue_dir, include_failed=False):
+    states = ("claimed", "failed") if include_failed else ("claimed",)
+    requeued = []
+    for state in states:
+        for job_name in sorted(os.listdir(_queue_path(queue_dir, state))):
+            os.rename(_queue_path(queue_dir, state, job_name), _queue_path(queue_dir, "pending", job_name))
+            requeued.append(job_name)
+    return requeued
+
+####################
+# Merge
+####################
+
+def merge_shards(shard_dirs, output_dir, summary_name=summary.SUMMARY_FILENAME,
+                 index_name=capability_index.INDEX_FILENAME):
+    """
+    Combines the outputs of the shard run directories into output_dir:
+    query results (.csv and .pkl), grid checkpoints (renumbered into one grids/ store), summary
+    tables, capability indexes and manifests. Outputs missing from a shard (i.e. a shard without
+    any stars, or a --no_plot shard without grids) are skipped.
+    Shards are keyed by input ID, so a star listed under two aliases (i.e. TIC and Gaia DR3) can be
+    processed by two shards; every merged output keeps only the first row of each source_id
+    """
+
+    query_results, summaries, indexes = [], [], []
+    merged_manifest = {}
+    grid_chunk_count = 0
+    grid_source_ids = set()
+    for shard_dir in shard_dirs:
+        query_results_path = os.path.join(shard_dir, "gaia_query_results.pkl")
+        if os.path.isfile(query_results_path):
+            query_results.append(pd.read_pickle(query_results_path))
+        else:
+            print(f"WARNING: {shard_dir} has no query results ({query_results_path}); they are left out of the merge.")
+
+        for chunk_path in sorted(glob.glob(os.path.join(shard_dir, "grids", "chunk_*.npz"))):
+            merged_chunk_path = os.path.join(output_dir, "grids", f"chunk_{grid_chunk_count:04d}.npz")
+            with np.load(chunk_path) as chunk_file:
+                chunk_grids = dict(chunk_file)
+            new_stars = np.array([source_id not in grid_source_ids for source_id in chunk_grids["source_id"].tolist()],
+                                 dtype=bool)
+            if not new_stars.any():
+                continue
+            if new_stars.all():
+                with checkpoint.atomic_path(merged_chunk_path) as tmp_path:
+                    shutil.copyfile(chunk_path, tmp_path)
+            else:
+                # Per-star arrays are indexed by star first; the mass grid is shared by all stars
+                checkpoint.atomic_savez(merged_chunk_path, **{
+                    name: array[new_stars] if name != "planet_mass_mjup" else array
+                    for name, array in chunk_grids.items()})
+            grid_source_ids.update(chunk_grids["source_id"].tolist())
+            grid_chunk_count += 1
+
+        summary_path = os.path.join(shard_dir, summary_name)
+        if os.path.isfile(summary_path):
+            summaries.append(pd.read_csv(summary_path) if summary_path.endswith(".csv") else pd.read_parquet(summary_path))
+
+        index_path = os.path.join(shard_dir, index_name)
+        if os.path.isfile(index_path):
+            indexes.append(capability_index.load_index(index_path))
+
+        # The plot paths of a shard manifest are relative to the shard directory; rebase them onto
+        #   the merged directory
+        for source_id, entry in manifest.load_manifest(os.path.join(shard_dir, "manifest.json")).items():
+            outputs = [os.path.relpath(os.path.join(shard_dir, path), output_dir) for path in entry["outputs"]]
+            merged_manifest.setdefault(source_id, {**entry, "outputs": outputs})
+
+    merged = {"grid_chunks": grid_chunk_count}
+    if query_results:
+        query_result_df = pd.concat(query_results, ignore_index=True).drop_duplicates("source_id", ignore_index=True)
+        checkpoint.atomic_to_csv(query_result_df, os.path.join(output_dir, "gaia_query_results.csv"))
+        checkpoint.atomic_to_pickle(query_result_df, os.path.join(output_dir, "gaia_query_results.pkl"))
+        merged["stars"] = len(query_result_df)
+    if summaries:
+        summary_df = pd.concat(summaries, ignore_index=True).drop_duplicates("source_id", ignore_index=True)
+        summary.save_summary(summary_df, os.path.join(output_dir, summary_name))
+        merged["summary_rows"] = len(summary_df)
+    if indexes:
+        merged_index = capability_index.merge_indexes(indexes)
+        capability_index.save_index(merged_index, os.path.join(output_dir, index_name))
+        merged["index_stars"] = len(merged_index["source_id"])
+    if merged_manifest:
+        manifest.save_manifest(merged_manifest, os.path.join(output_dir, "manifest.json"))
+        merged["manifest_entries"] = len(merged_manifest)
+    return merged
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue")
+    enqueue_parser.add_argument("queue")
+    enqueue_parser.add_argument("--shards", type=int, required=True)
+    enqueue_parser.add_argument("--output_root", default=".")
+
+    worker_parser = subparsers.add_parser("worker")
+    worker_parser.add_argument("queue")
+    worker_parser.add_argument("--worker_id")
+
+    requeue_parser = subparsers.add_parser("requeue")
+    requeue_parser.add_argument("queue")
+    requeue_parser.add_argument("--failed", action="store_true")
+
+    merge_parser = subparsers.add_parser("merge")
+    merge_parser.add_argument("shard_dirs", nargs="+")
+    merge_parser.add_argument("-o", "--output", required=True)
+    merge_parser.add_argument("--summary", default=summary.SUMMARY_FILENAME)
+    merge_parser.add_argument("--capability_index", default=capability_index.INDEX_FILENAME)
+
+    # The main.py arguments of an enqueued run follow a "--"
+    argv = sys.argv[1:]
+    main_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+
+    if args.command == "enqueue":
+        if args.shards < 1:
+            parser.error("--shards must be at least 1")
+        if not main_args:
+            parser.error("enqueue needs the main.py arguments of the run, i.e. -- big_list.csv --no_plot")
+        enqueue(args.queue, args.shards, main_args, args.output_root)
+        print(f"Queued {args.shards} shards in {args.queue}")
+    elif args.command == "worker":
+        failed_count = run_worker(args.queue, args.worker_id)
+        print(f"No pending shards left in {args.queue}")
+        sys.exit(1 if failed_count else 0)
+    elif args.command == "requeue":
+        requeued = requeue(args.queue, include_failed=args.failed)
+        print(f"Returned {len(requeued)} shards to {os.path.join(args.queue, 'pending')}")
+    else:
+        missing_dirs = [shard_dir for shard_dir in args.shard_dirs if not os.path.isdir(shard_dir)]
+        if missing_dirs:
+            parser.error(f"Shard directories not found: {missing_dirs}")
+        merged = merge_shards(args.shard_dirs, args.output, args.summary, args.capability_index)
+        print(f"Merged {len(args.shard_dirs)} shard directories into {args.output}: {merged}")
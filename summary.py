@@ -0,0 +1,84 @@
+# This file computes the per-star summary table of the headless (--no_plot) mode: the numbers a
+#   screening run needs from each star's SNR1 grids, without building the grids or importing
+#   matplotlib.
+#
+# Every quantity comes from the closed form of the SNR1 = 1 line, M_p * a = K (see
+#   utilities.snr1_threshold_constant), evaluated for all stars at once:
+#   - threshold_mass_mjup_<model>_<a>au: SNR1 = 1 mass at each of STANDARD_SEMI_MAJOR_AXES_AU
+#   - min_detectable_mass_mjup_<model>: SNR1 = 1 mass at the widest orbit of the star's period grid,
+#     clipped to the grid's mass range: the lightest grid mass if the whole mass range is
+#     detectable there, NaN if even the heaviest grid mass is not
+#   - detectable_fraction_<model>: fraction of the period/mass grid points with SNR1 >= 1
+#   for <model> theoretical and actual deviation angle.
+#
+# The table is written as Parquet, or as CSV when the file name ends in .csv.
+
+import numpy as np
+import pandas as pd
+
+import checkpoint
+import utilities
+
+SUMMARY_FILENAME = "gaia_summary.parquet"
+STANDARD_SEMI_MAJOR_AXES_AU = (0.1, 0.5, 1, 2, 3)
+# Stellar parameters copied into the summary next to the source_id
+SUMMARY_STAR_COLUMNS = ["phot_g_mean_mag", "distance_gspphot", "mass_flame"]
+# Number of stars per block of the detectable fraction computation, to bound its memory use
+DETECTABLE_FRACTION_BLOCK_SIZE = 50000
+
+def summary_table(query_result_df, n_obs=None):
+    """
+    Returns the summary table (one row per star) for the stars of a cleaned query result
+    n_obs: expected number of observations per star for the N_obs-aware SNR, or None
+    """
+
+    stellar_mass = query_result_df["mass_flame"].to_numpy(dtype=float)
+    distance = query_result_df["distance_gspphot"].to_numpy(dtype=float)
+    theoretical, actual = utilities.deviation_angles(query_result_df["phot_g_mean_mag"].to_numpy(dtype=float))
+
+    period_days, planet_masses = utilities.period_mass_grid()
+    converted_period_years = (period_days / 365.25)**(2/3)
+    a_max = utilities.semi_maj_axis_conversion(converted_period_years[-1], stellar_mass)
+
+    columns = {"source_id": query_result_df["source_id"].to_numpy(dtype=np.int64)}
+    for column in SUMMARY_STAR_COLUMNS:
+        columns[column] = query_result_df[column].to_numpy()
+    if n_obs is not None:
+        columns["expected_n_obs"] = np.asarray(n_obs)
+
+    for model, deviation_angle in (("theoretical", theoretical), ("actual", actual)):
+        k = utilities.snr1_threshold_constant(stellar_mass, distance, deviation_angle, n_obs)
+        for a_au in STANDARD_SEMI_MAJOR_AXES_AU:
+            columns[f"threshold_mass_mjup_{model}_{a_au:g}au"] = k / a_au
+        min_mass = np.maximum(k / a_max, planet_masses[0])
+        columns[f"min_detectable_mass_mjup_{model}"] = np.where(min_mass <= planet_masses[-1], min_mass, np.nan)
+        columns[f"detectable_fraction_{model}"] = detectable_fraction(k, stellar_mass, converted_period_years,
+                                                                       planet_masses)
+    return pd.DataFrame(columns)
+
+def detectable_fraction(k, stellar_mass_solar, converted_period_years, planet_masses_jup):
+    """
+    Fraction of the period/mass grid points with SNR1 >= 1 for each star with threshold constant k
+    Per period, the detectable masses are those >= K / a, counted with a binary search on the
+    (sorted) mass grid
+    """
+
+    fraction = np.empty(len(k))
+    n_points = len(converted_period_years) * len(planet_masses_jup)
+    for start in range(0, len(k), DETECTABLE_FRACTION_BLOCK_SIZE):
+        block = slice(start, start + DETECTABLE_FRACTION_BLOCK_SIZE)
+        semi_major_axis = utilities.semi_maj_axis_conversion(converted_period_years[None, :],
+                                                             stellar_mass_solar[block, None])
+        threshold_mass = k[block, None] / semi_major_axis
+        # NaN thresholds (missing stellar parameters) sort last and count as undetectable
+        undetectable = np.searchsorted(planet_masses_jup, threshold_mass.ravel(), side="left")
+        detectable = len(planet_masses_jup) - undetectable.reshape(threshold_mass.shape)
+        fraction[block] = detectable.sum(axis=1) / n_points
+    return fraction
+
+def save_summary(summary_df, path):
+    with checkpoint.atomic_path(path) as tmp_path:
+        if path.endswith(".csv"):
+            summary_df.to_csv(tmp_path, index=False)
+        else:
+            summary_df.to_parquet(tmp_path, index=False)
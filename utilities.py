@@ -32,30 +32,59 @@ def astrometric_signature_grid(
 
     return alpha_mas
 
+# Piecewise fits of the theoretical and actual deviation angles (mas) against the G-magnitude of the
+#   host star; estimated from fig A.1 Lindegren et al. 2021 Gaia EDR3
+#   Each segment is (upper magnitude bound, scale, base): deviation angle = scale * base**magnitude
+THEORETICAL_DEVIATION_ANGLE_FIT = (
+    (8.25, 0.0032103219442715437, 1.5802904035394523),
+    (12, 0.09773642956267346, 0.9517614440673656),
+    (np.inf, 0.00020571612193689604, 1.6186445827673461),
+)
+ACTUAL_DEVIATION_ANGLE_FIT = (
+    (6, 48.828124999999986, 0.4),
+    (13.5, 0.2822924808032303, 0.9441806901029314),
+    (np.inf, 0.00021046513935797287, 1.6096194031076707),
+)
+
 # Based on the magnitude of the host star, assign theoretical and actual deviation angles
-#   based on pre-defined functions; estimated from fig A.1 Lindegren et al. 2021 Gaia EDR3
+#   Evaluated with scalar arithmetic, so the values (and the manifest fingerprints sampled from
+#   them, see manifest.py) are bit-for-bit those of earlier versions
 def assign_deviation_angles(magnitude):
-    if magnitude <= 8.25:
-        theoretical = 0.0032103219442715437 * (1.5802904035394523**magnitude)
-    elif 8.25 < magnitude <= 12:
-        theoretical = 0.09773642956267346 * (0.9517614440673656**magnitude)
-    elif magnitude > 12:
-        theoretical = 0.00020571612193689604 * (1.6186445827673461**magnitude)
-    else:
-        theoretical = np.nan
-    
-    if magnitude <= 6:
-        actual = 48.828124999999986 * (0.4**magnitude)
-    elif 6 < magnitude <= 13.5:
-        actual = 0.2822924808032303 * (0.9441806901029314**magnitude)
-    elif magnitude > 13.5:
-        actual = 0.00021046513935797287 * (1.6096194031076707**magnitude)
-    else:
-        actual = np.nan
-
-    assert 'theoretical' in locals(), "Theoretical deviation angle not assigned!"
-    assert 'actual' in locals(), "Actual deviation angle not assigned!"
-    return theoretical, actual
+    return _piecewise_fit_scalar(magnitude, THEORETICAL_DEVIATION_ANGLE_FIT), _piecewise_fit_scalar(magnitude, ACTUAL_DEVIATION_ANGLE_FIT)
+
+def _piecewise_fit_scalar(magnitude, fit):
+    for upper_bound, scale, base in fit:
+        if magnitude <= upper_bound:
+            return scale * (base**magnitude)
+    return np.nan
+
+# Theoretical and actual deviation angles for an array of G-magnitudes (NaN for a NaN magnitude)
+def deviation_angles(magnitudes):
+    magnitudes = np.asarray(magnitudes, dtype=float)
+    return _piecewise_fit(magnitudes, THEORETICAL_DEVIATION_ANGLE_FIT), _piecewise_fit(magnitudes, ACTUAL_DEVIATION_ANGLE_FIT)
+
+def _piecewise_fit(magnitudes, fit):
+    conditions = [magnitudes <= upper_bound for upper_bound, _, _ in fit]
+    values = [scale * base**magnitudes for _, scale, base in fit]
+    return np.select(conditions, values, default=np.nan)
+
+# Closed form of the SNR1 = 1 line: SNR1 = 0.95479 * M_p * a / (M_star * d * deviation_angle), so a
+#   companion is at or above SNR1 = 1 where M_p * a >= K, with K (M_J AU) returned here
+#   The threshold mass at semi-major axis a is K / a
+def snr1_threshold_constant(stellar_mass_solar, distance_pc, deviation_angle_mas, n_obs=None):
+    if n_obs is not None:
+        deviation_angle_mas = deviation_angle_mas / np.sqrt(n_obs)
+    return deviation_angle_mas * stellar_mass_solar * distance_pc / 0.95479
+
+# Bounds and resolution of the period/mass grid: (min, max, number of points), log spaced
+#   Periods in days, masses in Jupiter masses
+PERIOD_GRID_DAYS = (10, 2000, 100)  # 10 → 2000 days
+MASS_GRID_MJUP = (0.3, 200, 100)  # 0.3 → 200 M_jup
+
+# Description of the period/mass grid; recorded with a run's outputs so a change to the grid
+#   can be detected on the next run
+def grid_spec():
+    return {"period_days": list(PERIOD_GRID_DAYS), "mass_mjup": list(MASS_GRID_MJUP)}
 
 # TO DO: Make the resolution of the period/mass grid based on config file input
 #        - Still planning to add a smoothing funciton though
@@ -63,9 +92,11 @@ def assign_deviation_angles(magnitude):
 def period_mass_grid():
     # Create a grid of RxC numbers (based on config) for planet masses and orbital periods (days)
     #   evenly spaced in log space
-    planet_period = np.logspace(np.log10(10), np.log10(2000), 100)  # 10 → 2000 days
+    p_min, p_max, p_num = PERIOD_GRID_DAYS
+    m_min, m_max, m_num = MASS_GRID_MJUP
+    planet_period = np.logspace(np.log10(p_min), np.log10(p_max), p_num)
     # planet_period = np.logspace(np.log10(10), np.log10(4000), 100)  # 10 → 4000 days
-    planet_masses = np.logspace(np.log10(0.3), np.log10(200), 100)  # 0.01 → 200 M_jup
+    planet_masses = np.logspace(np.log10(m_min), np.log10(m_max), m_num)
     # print(planet_masses)
     # P, M = np.meshgrid(planet_period, planet_masses)
     return planet_period, planet_masses
@@ -79,12 +110,27 @@ def a_to_period(a_au, stellar_mass_solar):
 def semi_maj_axis_conversion(converted_period_years, stellar_mass_solar):
     return (converted_period_years * (stellar_mass_solar)**(1/3))
 
-def snr_grid(alpha_grid, gaia_mag):
+# n_obs: expected number of Gaia observations of the star (see obs_counts.py); when given, the
+#   single-epoch deviation angles are reduced by sqrt(n_obs), the precision of the combined fit
+def snr_grid(alpha_grid, gaia_mag, n_obs=None):
     theoretical_dev_angle, actual_dev_angle = assign_deviation_angles(gaia_mag)
+    if n_obs is not None:
+        theoretical_dev_angle /= np.sqrt(n_obs)
+        actual_dev_angle /= np.sqrt(n_obs)
     snr_1_grid_theoretical  = alpha_grid / theoretical_dev_angle
     snr_1_grid_actual  = alpha_grid / actual_dev_angle
     return snr_1_grid_theoretical, snr_1_grid_actual
 
+# Semi-major axes (AU) and the theoretical and actual deviation angle SNR1 grids for one star
+#   converted_period_years is (P/365.25)^(2/3) for the period grid, shared by all stars
+def star_snr_grids(stellar_mass_solar, distance_pc, gaia_mag, converted_period_years, planet_masses_jup,
+                   n_obs=None):
+    semi_major_axis_au = semi_maj_axis_conversion(converted_period_years, stellar_mass_solar)
+    alpha_grid = astrometric_signature_grid(stellar_mass_solar, distance_pc, semi_major_axis_au,
+                                            planet_masses_jup)
+    snr_1_grid_theoretical, snr_1_grid_actual = snr_grid(alpha_grid, gaia_mag, n_obs)
+    return semi_major_axis_au, snr_1_grid_theoretical, snr_1_grid_actual
+
 def estimate_stellar_mass(g_mag, bp_mag, rp_mag, distance):
     # Placeholder function for estimating stellar mass based on Gaia photometry and distance
     # This is a very rough estimate and should be replaced with a more accurate method